@@ -36,6 +36,8 @@ def generate_avatar(req: GenerateAvatarRequest):
         "created_at": time.time(),
         "progress": 0.0,
         "output_url": None,
+        "playlist_url": None,
+        "playlist_urls": {},
         "error": None,
     }
     _jobs[job_id] = job
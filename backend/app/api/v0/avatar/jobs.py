@@ -13,6 +13,10 @@ class JobStatusUpdate(BaseModel):
     progress: Optional[float] = None
     output_url: Optional[str] = None
     error: Optional[str] = None
+    # HLS playlist that grows while the job runs (progressive output), for
+    # `style_id` (default: the job's style)
+    playlist_url: Optional[str] = None
+    style_id: Optional[str] = None
 
 
 @router.get("/jobs/{job_id}")
@@ -36,6 +40,11 @@ def update_job(job_id: str, update: JobStatusUpdate):
         job["output_url"] = update.output_url
     if update.error:
         job["error"] = update.error
+    if update.playlist_url:
+        style_id = update.style_id or job["style_id"]
+        job.setdefault("playlist_urls", {})[style_id] = update.playlist_url
+        if style_id == job["style_id"]:
+            job["playlist_url"] = update.playlist_url
     return job
 
 
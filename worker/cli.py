@@ -4,7 +4,7 @@ import os
 import uuid
 from pathlib import Path
 
-from pipelines.avatar.run_job import dispatch
+from pipelines.avatar.run_job import dispatch, dispatch_multi
 from pipelines.avatar.style_config import STYLES
 import config
 
@@ -18,6 +18,8 @@ def apply_tier_preset(tier: str):
             "KEYFRAME_INTERVAL": 1,
             "INFERENCE_WIDTH": 0,
             "INFERENCE_HEIGHT": 0,
+            "ENCODE_PRESET": "medium",
+            "ENCODE_CRF": 18,
         },
         "2": {
             "USE_LCM_LORA": True,
@@ -25,6 +27,8 @@ def apply_tier_preset(tier: str):
             "KEYFRAME_INTERVAL": 5,
             "INFERENCE_WIDTH": 512,
             "INFERENCE_HEIGHT": 512,
+            "ENCODE_PRESET": "medium",
+            "ENCODE_CRF": 18,
         },
         "3": {
             "USE_LCM_LORA": True,
@@ -33,12 +37,16 @@ def apply_tier_preset(tier: str):
             "INFERENCE_WIDTH": 384,
             "INFERENCE_HEIGHT": 384,
             "ENABLE_UPSCALING": True,
+            "ENCODE_PRESET": "veryfast",
+            "ENCODE_CRF": 20,
         },
         "baseline": {
             "USE_LCM_LORA": False,
             "KEYFRAME_INTERVAL": 1,
             "INFERENCE_WIDTH": 0,
             "INFERENCE_HEIGHT": 0,
+            "ENCODE_PRESET": "medium",
+            "ENCODE_CRF": 18,
         },
     }
 
@@ -76,6 +84,10 @@ def main():
         default="2",
         help="Optimization tier (1=conservative 4-6min, 2=balanced 1-2min [default], 3=aggressive 30-60sec, baseline=no optimization 30-40min)",
     )
+    parser.add_argument(
+        "--backend-job-id", default=None,
+        help="Backend job to report progress to (e.g. the HLS playlist URL)",
+    )
     args = parser.parse_args()
 
     # Apply tier preset
@@ -90,6 +102,33 @@ def main():
     output_dir = Path(args.output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if len(styles_to_run) > 1:
+        # Decode, landmarks and depth are shared; only the style stages repeat
+        job_id = str(uuid.uuid4())[:8]
+        job_dir = output_dir / f"job_{job_id}_all"
+        output_videos = {
+            style_id: str(output_dir / f"output_{style_id}_{input_path.stem}.mp4")
+            for style_id in styles_to_run
+        }
+
+        print(f"\n{'=' * 60}")
+        print(f"Styles: {', '.join(styles_to_run)}")
+        print(f"Job dir: {job_dir}")
+        for style_id, output_path in output_videos.items():
+            print(f"Output ({style_id}): {output_path}")
+        print(f"{'=' * 60}\n")
+
+        dispatch_multi(
+            job_id=job_id,
+            pipeline="output_a",
+            input_video=str(input_path),
+            output_videos=output_videos,
+            job_dir=str(job_dir),
+            seed=args.seed,
+            backend_job_id=args.backend_job_id,
+        )
+        return
+
     for style_id in styles_to_run:
         job_id = str(uuid.uuid4())[:8]
         job_dir = output_dir / f"job_{job_id}_{style_id}"
@@ -109,6 +148,7 @@ def main():
             style_id=style_id,
             job_dir=str(job_dir),
             seed=args.seed,
+            backend_job_id=args.backend_job_id,
         )
 
 
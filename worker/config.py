@@ -48,13 +48,112 @@ LCM_STEPS = 6  # 4-8 recommended (6 = balanced quality/speed)
 
 # ── Keyframe Optimization ──
 KEYFRAME_INTERVAL = 5  # 1=all frames (slow), 5=1 in 5 (balanced), 10=1 in 10 (fast)
-INTERPOLATION_METHOD = "opencv_dis"  # Optical flow method
+# "source_flow": bidirectional warp with DIS flow from the (downscaled) source
+#                frames, cached per gap and shared by all styles
+# "opencv_dis":  DIS flow between the stylized keyframes + crossfade (legacy)
+INTERPOLATION_METHOD = "source_flow"
+FLOW_MAX_SIDE = 512  # Source flow is computed at most this many pixels wide/high
+INTERPOLATE_WORKERS = 4  # Keyframe gaps interpolated in parallel (OpenCV releases the GIL)
+# "fixed":    every KEYFRAME_INTERVAL-th frame
+# "adaptive": place keyframes by source motion (more on head turns, fewer on
+#             static stretches) within the same budget as "fixed"
+KEYFRAME_MODE = "fixed"
+KEYFRAME_BUDGET = 0  # Adaptive: max keyframes per job (0 = as many as "fixed" would use)
+KEYFRAME_MAX_MOTION = 0.0  # Adaptive: max summed motion per gap (0 = budget only)
+KEYFRAME_MAX_GAP = 20  # Adaptive: never interpolate across more frames than this
+# Refinement: after interpolation, stylize an extra keyframe in gaps where
+# flow interpolation cannot reproduce the source frames (occlusions, fast
+# turns) and re-interpolate just those gaps.
+REFINE_MAX_KEYFRAMES = 0  # Cap on extra diffusion calls per style (0 = off)
+REFINE_ERROR_THRESHOLD = 12.0  # Mean |interpolated - real| source error (0-255)
 
 # ── Resolution Optimization ──
 INFERENCE_WIDTH = 512   # 0=original (slow), 512=balanced, 384=fast
 INFERENCE_HEIGHT = 512  # Match INFERENCE_WIDTH
 ENABLE_UPSCALING = False  # Set to True to upscale back to original resolution
 
+# ── Pipeline Cache ──
+# Loaded diffusion pipelines stay in memory across styles and jobs in the same
+# process; least recently used ones are evicted beyond this budget (0 = no limit).
+PIPELINE_CACHE_MB = 12000
+
+# ── Stylized Keyframe Cache ──
+# Content-addressed (inputs + generation settings) cache of diffusion results
+# on the volume, reused across tiers and re-submitted uploads.
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_DIR = VOLUME_ROOT / "stylize_cache"
+RESULT_CACHE_MB = 20000  # LRU size bound (0 = unbounded)
+
+# ── Prompt Embeddings ──
+PROMPT_EMBED_CACHE_SIZE = 32  # (style, prompt) embeddings kept for reuse
+
+# ── Diffusion Batching ──
+STYLIZE_BATCH_SIZE = 1  # Keyframes per pipeline call (0 = auto from free GPU memory)
+STYLIZE_MAX_BATCH_SIZE = 8  # Upper bound for auto sizing
+STYLIZE_MB_PER_MEGAPIXEL = 2500  # Auto sizing: GPU memory per image per megapixel
+STYLIZE_CPU_BATCH_SIZE = 4  # Auto sizing on CPU
+
+# ── Face ROI Stylization ──
+# Diffuse only a padded box around the face (from the landmarks) at the
+# inference resolution and feather-blend it back into the full frame.
+# More face detail per diffusion pixel, so INFERENCE_WIDTH can often drop.
+STYLIZE_FACE_ROI = False
+FACE_ROI_PADDING = 0.35   # Margin around the landmark extent (fraction of face size)
+FACE_ROI_SMOOTHING = 0.8  # Temporal smoothing of the box (0 = none)
+FACE_ROI_FEATHER = 0.1    # Blend ramp width (fraction of box size)
+
+# ── Decode ──
+# "png":  extract every frame to frames/*.png once (stages re-read the PNGs)
+# "pipe": stream rawvideo from ffmpeg into memory, no per-frame scratch files
+DECODE_MODE = "pipe"
+DECODE_BUFFER_FRAMES = 8  # Decoded frames queued ahead of the consumer
+
+# ── Face Landmarks ──
+LANDMARK_TRACKING = True  # VIDEO-mode tracking; re-detects only when the face is lost
+
+# ── Depth ──
+DEPTH_BATCH_SIZE = 4  # Frames per DPT forward pass (raise on GPU, 2-4 on CPU)
+# "torch": transformers DPT on DEVICE; "onnx": ONNX Runtime on CPU (CPU-only nodes).
+# The ONNX export is created once under MODELS_DIR/depth_onnx and checked
+# against the torch output before first use.
+DEPTH_BACKEND = "torch"
+DEPTH_ONNX_QUANTIZE = False  # Dynamic int8 weights (faster on CPU, check parity)
+DEPTH_CPU_THREADS = 0  # Intra-op threads on CPU (0 = runtime default)
+DEPTH_PARITY_TOLERANCE = 2.0  # Max mean |diff| vs torch, in 0-255 depth levels
+
+# ── Encode ──
+# "pipe":  post-processed frames stream straight into ffmpeg's stdin
+# "track": write the final frame track to disk, then encode the file (fallback)
+ENCODE_MODE = "pipe"
+ENCODE_PRESET = "medium"  # libx264 preset (set per tier by the CLI)
+ENCODE_CRF = 18  # libx264 quality (lower = better, larger)
+# Time segments encoded concurrently as closed-GOP parts, then concatenated
+# without re-encoding (1 = single encoder, 0 = one per ENCODE_SEGMENT_CORES cores).
+# Segments encode from the final track, so with more than one the "pipe"
+# mode writes that track first.
+ENCODE_SEGMENTS = 1
+ENCODE_SEGMENT_CORES = 4
+ENCODE_MIN_SEGMENT_FRAMES = 120  # Never split into shorter segments
+# Progressive output (ENCODE_MODE="pipe"): encode to fMP4/HLS segments with a
+# growing playlist next to the output MP4 (<name>_hls/playlist.m3u8) so
+# playback starts while the job runs; the MP4 is remuxed from the segments.
+# Replaces segmented parallel encoding. With refinement off and
+# STAGE_WORKERS >= 3 the playlist grows while keyframes are still being
+# stylized; with REFINE_MAX_KEYFRAMES > 0 it starts only after refinement.
+PROGRESSIVE_OUTPUT = False
+HLS_SEGMENT_SECONDS = 2
+# Public URL under which the output directory is served; the playlist URL
+# reported to the backend is relative to it (empty = nothing reported)
+OUTPUT_BASE_URL = os.getenv("OUTPUT_BASE_URL", "")
+
+# ── Stage Scheduling ──
+# Stages run as a dependency graph: independent ones (face landmarks / depth)
+# concurrently, interpolation fills keyframe gaps while stylization is still
+# producing later keyframes, and (refinement off, streamed encode) the
+# finished prefix of the styled track is post-processed and encoded meanwhile.
+STAGE_WORKERS = 3  # Max stages running at once (1 = sequential, 2 = no streamed encode)
+STREAM_QUEUE_SIZE = 16  # Stylized keyframes queued ahead of interpolation
+
 # ── Hugging Face ──
 HF_TOKEN = os.getenv("HF_TOKEN", "")
 
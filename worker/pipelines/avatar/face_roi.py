@@ -0,0 +1,109 @@
+"""Face region-of-interest helpers for ROI stylization.
+
+Boxes come from the saved face landmarks, padded, fitted to the inference
+aspect ratio and smoothed over time so the crop does not jitter between
+keyframes. Stylized crops are feather-blended back into the full frame.
+"""
+import numpy as np
+
+
+def face_boxes(
+    landmarks: np.ndarray,
+    detected: np.ndarray,
+    width: int,
+    height: int,
+    aspect: float,
+    padding: float,
+    smoothing: float,
+) -> np.ndarray:
+    """Temporally stable face boxes, one per landmark slot.
+
+    Args:
+        landmarks: (K, 478, 3) normalized landmarks
+        detected: (K,) bool mask of slots with a face
+        width, height: Source frame size in pixels
+        aspect: Box width / height (the inference aspect ratio)
+        padding: Extra margin around the landmark extent, as a fraction of its size
+        smoothing: 0 = no smoothing, towards 1 = steadier (forward-backward EMA)
+
+    Returns:
+        (K, 4) int array of (x0, y0, x1, y1) pixel boxes. All slots get the
+        full frame if no face was detected anywhere.
+    """
+    count = len(detected)
+    if not detected.any():
+        return np.tile(np.array([0, 0, width, height]), (count, 1))
+
+    xy = landmarks[:, :, :2].astype(np.float32) * np.array([width, height], dtype=np.float32)
+    lo, hi = xy.min(axis=1), xy.max(axis=1)
+    center = (lo + hi) / 2
+    # Box height that covers the face extent at the target aspect ratio
+    size = np.maximum(hi[:, 1] - lo[:, 1], (hi[:, 0] - lo[:, 0]) / aspect) * (1 + 2 * padding)
+    params = np.column_stack([center, size])
+
+    # Slots without a face take the nearest detected slot's box
+    found = np.flatnonzero(detected)
+    nearest = found[np.abs(np.arange(count)[:, None] - found[None, :]).argmin(axis=1)]
+    params = params[nearest]
+
+    # Zero-phase exponential smoothing of center and size
+    if smoothing > 0:
+        for k in range(1, count):
+            params[k] = smoothing * params[k - 1] + (1 - smoothing) * params[k]
+        for k in range(count - 2, -1, -1):
+            params[k] = smoothing * params[k + 1] + (1 - smoothing) * params[k]
+
+    boxes = np.zeros((count, 4), dtype=np.int64)
+    for k, (cx, cy, box_h) in enumerate(params):
+        box_h = min(box_h, height, width / aspect)
+        box_w = box_h * aspect
+        x0 = int(round(np.clip(cx - box_w / 2, 0, width - box_w)))
+        y0 = int(round(np.clip(cy - box_h / 2, 0, height - box_h)))
+        boxes[k] = (x0, y0, min(width, x0 + int(round(box_w))), min(height, y0 + int(round(box_h))))
+    return boxes
+
+
+def crop_landmarks(
+    landmarks: np.ndarray, box: np.ndarray, width: int, height: int
+) -> np.ndarray:
+    """Re-normalize full-frame landmarks to the coordinates of `box`."""
+    x0, y0, x1, y1 = box
+    cropped = landmarks.astype(np.float32).copy()
+    cropped[:, 0] = (cropped[:, 0] * width - x0) / (x1 - x0)
+    cropped[:, 1] = (cropped[:, 1] * height - y0) / (y1 - y0)
+    return cropped
+
+
+def feather_mask(box: np.ndarray, width: int, height: int, feather: float) -> np.ndarray:
+    """(h, w, 1) float32 alpha for pasting a crop back: 1 inside, ramping to 0
+    over `feather` * min(w, h) pixels at box edges that are not frame edges."""
+    x0, y0, x1, y1 = box
+    box_w, box_h = x1 - x0, y1 - y0
+    ramp = max(1.0, feather * min(box_w, box_h))
+
+    def _edge_ramp(n: int, fade_start: bool, fade_end: bool) -> np.ndarray:
+        pos = np.arange(n, dtype=np.float32)
+        alpha = np.ones(n, dtype=np.float32)
+        if fade_start:
+            alpha = np.minimum(alpha, (pos + 1) / ramp)
+        if fade_end:
+            alpha = np.minimum(alpha, (n - pos) / ramp)
+        return np.clip(alpha, 0, 1)
+
+    alpha_x = _edge_ramp(box_w, x0 > 0, x1 < width)
+    alpha_y = _edge_ramp(box_h, y0 > 0, y1 < height)
+    return (alpha_y[:, None] * alpha_x[None, :])[:, :, None]
+
+
+def paste_back(
+    frame: np.ndarray, crop: np.ndarray, box: np.ndarray, feather: float
+) -> np.ndarray:
+    """Blend a (box-sized) stylized crop into a copy of `frame`."""
+    height, width = frame.shape[:2]
+    x0, y0, x1, y1 = box
+    alpha = feather_mask(box, width, height, feather)
+    result = frame.copy()
+    region = result[y0:y1, x0:x1].astype(np.float32)
+    blended = crop.astype(np.float32) * alpha + region * (1 - alpha)
+    result[y0:y1, x0:x1] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+    return result
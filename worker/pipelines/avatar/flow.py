@@ -0,0 +1,100 @@
+"""Optical flow between source frames, shared by the temporal stages.
+
+Flow is computed with DIS on grayscale source frames downscaled to at most
+config.FLOW_MAX_SIDE pixels: the real footage has stable texture, unlike
+stylized keyframes with hallucinated detail, and small frames are cheap.
+Each thread reuses one DIS instance. Forward and backward fields per
+keyframe gap are cached as float16 .npy files next to the other shared
+intermediates, so interpolation, refinement and later temporal stages all
+reuse them.
+"""
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+_local = threading.local()
+
+
+def _dis():
+    """This thread's DIS instance (not safe to share between threads)."""
+    dis = getattr(_local, "dis", None)
+    if dis is None:
+        dis = _local.dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+    return dis
+
+
+def calc(gray_from: np.ndarray, gray_to: np.ndarray) -> np.ndarray:
+    """(H, W, 2) float32 flow such that gray_from(x) ~ gray_to(x + flow(x))."""
+    return _dis().calc(gray_from, gray_to, None)
+
+
+def flow_size(width: int, height: int, max_side: int) -> tuple[int, int]:
+    """(w, h) at which flow is computed for frames of the given size."""
+    scale = min(1.0, max_side / max(height, width))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def thumbnail(frame: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """RGB frame resized to `size` (w, h) with area averaging."""
+    if frame.shape[1::-1] == tuple(size):
+        return np.asarray(frame)
+    return cv2.resize(np.asarray(frame), size, interpolation=cv2.INTER_AREA)
+
+
+def to_gray(frame: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """Grayscale copy of an RGB frame at `size` (w, h)."""
+    return cv2.cvtColor(thumbnail(frame, size), cv2.COLOR_RGB2GRAY)
+
+
+def resize_flow(flow: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """Resample a flow field to `size` (w, h), scaling the vectors to match."""
+    height, width = flow.shape[:2]
+    if (width, height) == tuple(size):
+        return flow.astype(np.float32, copy=False)
+    resized = cv2.resize(flow.astype(np.float32, copy=False), size, interpolation=cv2.INTER_LINEAR)
+    resized[:, :, 0] *= size[0] / width
+    resized[:, :, 1] *= size[1] / height
+    return resized
+
+
+def _cache_path(cache_dir: Path, before: int, after: int, max_side: int) -> Path:
+    return cache_dir / f"{before:06d}_{after:06d}_{max_side}.npy"
+
+
+def gap_flows(
+    source: np.ndarray,
+    before: int,
+    after: int,
+    cache_dir: Path = None,
+    max_side: int = 512,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Forward (before -> after) and backward (after -> before) flow between
+    two source frames, at flow_size resolution.
+
+    With `cache_dir`, fields are loaded from / stored to a float16 cache.
+    """
+    height, width = source.shape[1:3]
+    size = flow_size(width, height, max_side)
+    path = _cache_path(cache_dir, before, after, max_side) if cache_dir else None
+    if path is not None and path.exists():
+        cached = np.load(path)
+        if cached.shape == (2, size[1], size[0], 2):
+            return cached[0].astype(np.float32), cached[1].astype(np.float32)
+
+    gray_before = to_gray(source[before], size)
+    gray_after = to_gray(source[after], size)
+    fwd = calc(gray_before, gray_after)
+    bwd = calc(gray_after, gray_before)
+
+    if path is not None:
+        # Return the cached precision too, so a fresh run and a resumed one
+        # interpolate identically
+        fields = np.stack([fwd, bwd]).astype(np.float16)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp.npy")
+        np.save(tmp_path, fields)
+        tmp_path.replace(path)
+        return fields[0].astype(np.float32), fields[1].astype(np.float32)
+    return fwd, bwd
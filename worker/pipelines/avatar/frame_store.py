@@ -0,0 +1,97 @@
+"""Memory-mapped frame tracks shared by the Output A stages.
+
+A track is one fixed-shape (N, H, W, C) uint8 array stored as a raw
+`<name>.u8` file next to a small `<name>.json` header (shape + extra
+metadata). Stages read frames as zero-copy NumPy views and write them by
+index, so nothing is PNG-encoded between stages. Tracks live in the job
+directory, which keeps the manifest-based resume working.
+"""
+import json
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+
+def track_path(store_dir: Path, name: str) -> Path:
+    """Path of the raw frame data for track `name`."""
+    return store_dir / f"{name}.u8"
+
+
+def _header_path(store_dir: Path, name: str) -> Path:
+    return store_dir / f"{name}.json"
+
+
+def _write_header(store_dir: Path, name: str, shape: tuple, meta: dict):
+    header = {"shape": list(shape), "dtype": "uint8", **meta}
+    _header_path(store_dir, name).write_text(json.dumps(header, indent=2))
+
+
+def track_exists(store_dir: Path, name: str) -> bool:
+    """True if track `name` has both its data file and header."""
+    return track_path(store_dir, name).exists() and _header_path(store_dir, name).exists()
+
+
+def track_meta(store_dir: Path, name: str) -> dict:
+    """Read the header of track `name` (shape, dtype and any extra metadata)."""
+    return json.loads(_header_path(store_dir, name).read_text())
+
+
+def create_track(
+    store_dir: Path,
+    name: str,
+    count: int,
+    height: int,
+    width: int,
+    channels: int = 3,
+    **meta,
+) -> np.memmap:
+    """Create a zero-filled track and return it as a writable memmap."""
+    store_dir.mkdir(parents=True, exist_ok=True)
+    shape = (count, height, width, channels)
+    _write_header(store_dir, name, shape, meta)
+    return np.memmap(track_path(store_dir, name), dtype=np.uint8, mode="w+", shape=shape)
+
+
+def write_track(
+    store_dir: Path,
+    name: str,
+    frames: Iterable[np.ndarray],
+    **meta,
+) -> np.memmap:
+    """Write a stream of equally shaped frames of unknown length to a track.
+
+    Frames are appended sequentially; the header is written last, once the
+    frame count is known. Returns the finished track as a read-only memmap.
+    """
+    store_dir.mkdir(parents=True, exist_ok=True)
+    _header_path(store_dir, name).unlink(missing_ok=True)
+    count = 0
+    frame_shape = None
+    with open(track_path(store_dir, name), "wb") as f:
+        for frame in frames:
+            if frame.ndim == 2:
+                frame = frame[:, :, np.newaxis]
+            if frame_shape is None:
+                frame_shape = frame.shape
+            elif frame.shape != frame_shape:
+                raise ValueError(
+                    f"Track '{name}': frame {count} has shape {frame.shape}, expected {frame_shape}"
+                )
+            f.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+            count += 1
+    if frame_shape is None:
+        raise ValueError(f"Track '{name}': no frames written")
+    _write_header(store_dir, name, (count, *frame_shape), meta)
+    return open_track(store_dir, name)
+
+
+def open_track(store_dir: Path, name: str, writable: bool = False) -> np.memmap:
+    """Open an existing track as a (N, H, W, C) memmap."""
+    header = track_meta(store_dir, name)
+    return np.memmap(
+        track_path(store_dir, name),
+        dtype=np.dtype(header["dtype"]),
+        mode="r+" if writable else "r",
+        shape=tuple(header["shape"]),
+    )
@@ -13,6 +13,8 @@ class BackendClient:
         progress: Optional[float] = None,
         output_url: Optional[str] = None,
         error: Optional[str] = None,
+        playlist_url: Optional[str] = None,
+        style_id: Optional[str] = None,
     ):
         """Update job status on the backend. Best-effort (no exceptions raised)."""
         try:
@@ -23,8 +25,12 @@ class BackendClient:
                 payload["output_url"] = output_url
             if error:
                 payload["error"] = error
+            if playlist_url:
+                payload["playlist_url"] = playlist_url
+            if style_id:
+                payload["style_id"] = style_id
             requests.patch(
-                f"{self.base_url}/v0/jobs/{job_id}",
+                f"{self.base_url}/v0/avatar/jobs/{job_id}",
                 json=payload,
                 timeout=5,
             )
@@ -0,0 +1,125 @@
+"""Keyframe selection for the stylize -> interpolate stages.
+
+"fixed" mode takes every KEYFRAME_INTERVAL-th frame. "adaptive" mode scores
+the motion between consecutive source frames (mean absolute difference of
+small grayscale thumbnails) and places keyframes so that no gap accumulates
+more motion than a threshold: static stretches get long gaps, head turns
+short ones. The threshold is either KEYFRAME_MAX_MOTION or the lowest one
+that fits the keyframe budget, whichever is larger.
+"""
+import math
+
+import cv2
+import numpy as np
+
+
+def motion_scores(frames: np.ndarray, max_side: int = 64) -> np.ndarray:
+    """Per-frame motion: scores[i] is the mean absolute difference (0-255)
+    between frames i-1 and i, on grayscale copies downscaled to at most
+    `max_side` pixels. scores[0] is 0."""
+    height, width = frames.shape[1:3]
+    scale = min(1.0, max_side / max(height, width))
+    small = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    scores = np.zeros(len(frames), dtype=np.float32)
+    prev = None
+    for i, frame in enumerate(frames):
+        thumb = cv2.resize(np.asarray(frame), small, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(thumb, cv2.COLOR_RGB2GRAY).astype(np.float32)
+        if prev is not None:
+            scores[i] = np.abs(gray - prev).mean()
+        prev = gray
+    return scores
+
+
+def _place(scores: np.ndarray, threshold: float, max_gap: int) -> list[int]:
+    """Greedy placement: start a new gap before its motion exceeds
+    `threshold` or its length exceeds `max_gap`. First and last frame are
+    always keyframes."""
+    num_frames = len(scores)
+    indices = [0]
+    acc = 0.0
+    for i in range(1, num_frames):
+        if acc + scores[i] > threshold and i - 1 > indices[-1]:
+            indices.append(i - 1)
+            acc = 0.0
+        acc += scores[i]
+        if i - indices[-1] >= max_gap:
+            indices.append(i)
+            acc = 0.0
+    if indices[-1] != num_frames - 1:
+        indices.append(num_frames - 1)
+    return indices
+
+
+def select_adaptive(
+    scores: np.ndarray,
+    budget: int,
+    max_motion: float = 0.0,
+    max_gap: int = 20,
+) -> list[int]:
+    """Motion-adaptive keyframe indices.
+
+    Args:
+        scores: Output of `motion_scores`
+        budget: Max number of keyframes (0 = unlimited). The max_gap limit
+            takes precedence if both cannot be met.
+        max_motion: Max summed motion per gap (0 = only the budget applies)
+        max_gap: Max distance between consecutive keyframes
+
+    Returns:
+        Sorted frame indices, always including the first and last frame.
+    """
+    num_frames = len(scores)
+    if num_frames <= 2:
+        return list(range(num_frames))
+    max_gap = max(1, max_gap)
+
+    # Keyframe count only falls as the threshold rises: bisect for the
+    # lowest threshold that fits the budget
+    threshold = max(max_motion, 0.0)
+    if budget > 0 and len(_place(scores, threshold, max_gap)) > budget:
+        lo, hi = threshold, float(scores.sum()) + 1.0
+        for _ in range(40):
+            mid = (lo + hi) / 2
+            if len(_place(scores, mid, max_gap)) > budget:
+                lo = mid
+            else:
+                hi = mid
+        threshold = hi
+    return _place(scores, threshold, max_gap)
+
+
+def select_keyframes(frames: np.ndarray, mode: str, interval: int) -> list[int]:
+    """Keyframe indices for the source track `frames`.
+
+    Args:
+        frames: (N, H, W, 3) source frames
+        mode: "fixed" or "adaptive" (see config.KEYFRAME_MODE)
+        interval: Keyframe spacing for "fixed"; sets the default budget of
+            "adaptive" (1 = every frame in either mode)
+    """
+    import config
+
+    num_frames = len(frames)
+    if interval <= 1:
+        return list(range(num_frames))
+    if mode == "fixed":
+        return list(range(0, num_frames, interval))
+    if mode != "adaptive":
+        raise ValueError(f"Unknown keyframe mode: {mode}")
+
+    budget = config.KEYFRAME_BUDGET or math.ceil(num_frames / interval)
+    scores = motion_scores(frames)
+    indices = select_adaptive(
+        scores,
+        budget=budget,
+        max_motion=config.KEYFRAME_MAX_MOTION,
+        max_gap=config.KEYFRAME_MAX_GAP,
+    )
+    gaps = np.diff(indices) if len(indices) > 1 else np.zeros(1, dtype=int)
+    print(
+        f"  Adaptive keyframes: {len(indices)}/{num_frames} "
+        f"(budget {budget}, gaps {gaps.min()}-{gaps.max()} frames)"
+    )
+    return indices
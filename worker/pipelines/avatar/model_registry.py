@@ -0,0 +1,155 @@
+"""In-process cache of diffusion pipelines, shared across jobs and styles.
+
+Pipelines are keyed by (model_id, dtype, device, lcm). The ControlNets are
+loaded once per (dtype, device) and shared by every pipeline; the VAE and
+text encoder are shared between pipelines built from the same base model
+repo, so a new style only loads its own UNet. Weights from different repos
+are never mixed, since fine-tuned bases (e.g. anime models) ship their own.
+
+Least recently used pipelines are evicted once the cached weights exceed
+config.PIPELINE_CACHE_MB.
+"""
+import gc
+import threading
+from collections import OrderedDict
+
+import torch
+from diffusers import (
+    AutoencoderKL,
+    ControlNetModel,
+    StableDiffusionControlNetImg2ImgPipeline,
+    UniPCMultistepScheduler,
+)
+from transformers import CLIPTextModel, CLIPTokenizer
+
+_lock = threading.RLock()
+# component key -> loaded module (shared between pipelines)
+_components: dict[tuple, object] = {}
+# pipeline key -> (pipeline, component keys it uses); most recently used last
+_pipelines: "OrderedDict[tuple, tuple[object, list[tuple]]]" = OrderedDict()
+
+
+def _torch_dtype(dtype_str: str) -> torch.dtype:
+    return torch.float16 if dtype_str == "float16" else torch.float32
+
+
+def _nbytes(module) -> int:
+    """Bytes of parameters + buffers of a torch module (0 for tokenizers)."""
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def _component(key: tuple, load):
+    if key not in _components:
+        _components[key] = load()
+    return _components[key]
+
+
+def _build(model_id: str, dtype_str: str, device: str, lcm: bool):
+    import config
+
+    dtype = _torch_dtype(dtype_str)
+    keys = {
+        "openpose": ("controlnet", config.CONTROLNET_OPENPOSE_ID, dtype_str, device),
+        "depth": ("controlnet", config.CONTROLNET_DEPTH_ID, dtype_str, device),
+        "vae": ("vae", model_id, dtype_str, device),
+        # LoRA loading may touch the text encoder, so LCM variants get their own
+        "text_encoder": ("text_encoder", model_id, dtype_str, device, lcm),
+        "tokenizer": ("tokenizer", model_id),
+    }
+    controlnets = [
+        _component(keys[name], lambda cid=keys[name][1]: ControlNetModel.from_pretrained(
+            cid, torch_dtype=dtype
+        ).to(device))
+        for name in ("openpose", "depth")
+    ]
+    vae = _component(keys["vae"], lambda: AutoencoderKL.from_pretrained(
+        model_id, subfolder="vae", torch_dtype=dtype
+    ).to(device))
+    text_encoder = _component(keys["text_encoder"], lambda: CLIPTextModel.from_pretrained(
+        model_id, subfolder="text_encoder", torch_dtype=dtype
+    ).to(device))
+    tokenizer = _component(keys["tokenizer"], lambda: CLIPTokenizer.from_pretrained(
+        model_id, subfolder="tokenizer"
+    ))
+
+    # Only the UNet (and scheduler) is specific to this pipeline
+    pipe = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
+        model_id,
+        controlnet=controlnets,
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        torch_dtype=dtype,
+        safety_checker=None,
+    )
+
+    if lcm:
+        from diffusers import LCMScheduler
+        pipe.load_lora_weights(config.LCM_LORA_ID)
+        pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
+    else:
+        pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
+
+    pipe.to(device)
+    pipe.enable_attention_slicing()
+    return pipe, list(keys.values())
+
+
+def cached_bytes() -> int:
+    """Total size of all cached weights (shared components counted once)."""
+    with _lock:
+        unets = sum(_nbytes(pipe.unet) for pipe, _ in _pipelines.values())
+        return unets + sum(_nbytes(c) for c in _components.values())
+
+
+def _drop_unused_components():
+    in_use = {key for _, keys in _pipelines.values() for key in keys}
+    for key in list(_components):
+        if key not in in_use:
+            del _components[key]
+
+
+def _release_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def trim(budget_mb: float, keep: tuple = None):
+    """Evict least recently used pipelines (never `keep`) until the cache
+    fits in `budget_mb`. A budget <= 0 means unlimited."""
+    if budget_mb <= 0:
+        return
+    with _lock:
+        evicted = False
+        for key in list(_pipelines):
+            if cached_bytes() <= budget_mb * 1024 ** 2:
+                break
+            if key == keep:
+                continue
+            del _pipelines[key]
+            _drop_unused_components()
+            evicted = True
+            print(f"  Evicted pipeline {key[0]} ({key[1]}, {key[2]}, lcm={key[3]}) from cache")
+        if evicted:
+            _release_memory()
+
+
+def get_pipeline(model_id: str, dtype_str: str, device: str, lcm: bool):
+    """Return the cached pipeline for this key, building it on first use."""
+    import config
+
+    key = (model_id, dtype_str, str(device), lcm)
+    with _lock:
+        if key in _pipelines:
+            _pipelines.move_to_end(key)
+            print(f"  Reusing cached pipeline for {model_id}")
+            return _pipelines[key][0]
+
+        pipe, component_keys = _build(model_id, dtype_str, str(device), lcm)
+        _pipelines[key] = (pipe, component_keys)
+        trim(config.PIPELINE_CACHE_MB, keep=key)
+        return pipe
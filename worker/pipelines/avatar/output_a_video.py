@@ -1,12 +1,23 @@
 """Output A pipeline: face-scan video -> stylized character video.
 
 Idempotent: re-running with the same job_dir skips completed stages
-(tracked via manifest.json).
+(tracked via manifest.json). Stages exchange frames through memory-mapped
+tracks under job_dir/tracks (see frame_store). Stages run through the
+scheduler: independent ones concurrently, and interpolation consumes
+keyframes while stylization is still producing them.
 """
+import dataclasses
 import json
+import shutil
+import threading
 import time
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Callable, Iterable
 
+import numpy as np
+
+from pipelines.avatar import frame_store, keyframes, scheduler
 from pipelines.avatar.style_config import get_style
 from pipelines.avatar.stages import (
     decode,
@@ -19,187 +30,729 @@ from pipelines.avatar.stages import (
 )
 import config
 
+# Concurrent stages share one manifest per directory
+_manifest_lock = threading.Lock()
+
 
 def _stage_done(manifest_path: Path, name: str) -> bool:
-    if manifest_path.exists():
-        m = json.loads(manifest_path.read_text())
-        return m.get(name, {}).get("done", False)
+    with _manifest_lock:
+        if manifest_path.exists():
+            m = json.loads(manifest_path.read_text())
+            return m.get(name, {}).get("done", False)
     return False
 
 
 def _mark_done(manifest_path: Path, name: str, meta: dict = None):
-    m = {}
-    if manifest_path.exists():
-        m = json.loads(manifest_path.read_text())
-    m[name] = {"done": True, "timestamp": time.time(), **(meta or {})}
-    manifest_path.write_text(json.dumps(m, indent=2))
+    with _manifest_lock:
+        m = {}
+        if manifest_path.exists():
+            m = json.loads(manifest_path.read_text())
+        m[name] = {"done": True, "timestamp": time.time(), **(meta or {})}
+        manifest_path.write_text(json.dumps(m, indent=2))
 
 
-def run(
-    input_video: Path,
-    output_video: Path,
-    style_id: str,
-    job_dir: Path,
-    seed: int = 42,
-) -> Path:
-    """Run the complete Output A pipeline.
+def _stage_cached(manifest_path: Path, name: str, store_dir: Path, *tracks: str) -> bool:
+    """Stage is done per the manifest and its output tracks are still on disk."""
+    return _stage_done(manifest_path, name) and all(
+        frame_store.track_exists(store_dir, t) for t in tracks
+    )
+
+
+def _controls_cached(
+    manifest_path: Path, name: str, store_dir: Path, track: str, indices: list[int]
+) -> bool:
+    """Like _stage_cached, but the control track must also cover `indices`
+    (it is stale if, e.g., the keyframe selection changed since it was computed)."""
+    if not _stage_cached(manifest_path, name, store_dir, track):
+        return False
+    have = frame_store.track_meta(store_dir, track).get("indices", [])
+    return set(indices) <= set(have)
+
+
+def _landmarks_cached(manifest_path: Path, landmarks_path: Path, indices: list[int]) -> bool:
+    """face_landmarks is done and its saved landmarks cover `indices`."""
+    if not (_stage_done(manifest_path, "face_landmarks") and landmarks_path.exists()):
+        return False
+    _, _, have = face_landmarks.load_landmarks(landmarks_path)
+    return set(indices) <= set(have)
+
+
+@dataclass
+class Preprocessed:
+    """Style-independent stage outputs, shared by every style of a job."""
+    video_meta: decode.VideoMeta
+    source: np.ndarray
+    keyframe_interval: int
+    keyframe_indices: list[int]
+    landmarks: np.ndarray
+    face_detected: np.ndarray
+    landmark_indices: list[int]
+    depth: np.ndarray
+    depth_indices: list[int]
+    # Per-gap source flow cache (see flow.gap_flows), shared by all styles
+    flow_dir: Path
+    # Cached postprocess.reference_stats of the source track (built on first use)
+    lab_stats_path: Path
+    # Completion timestamps of the shared stages; per-style results built on
+    # an older preprocessing run are discarded
+    fingerprint: dict
+
+
+def _reset_stages(manifest_path: Path, names: tuple):
+    with _manifest_lock:
+        if manifest_path.exists():
+            m = json.loads(manifest_path.read_text())
+            for name in names:
+                m.pop(name, None)
+            manifest_path.write_text(json.dumps(m, indent=2))
+
+
+def preprocess(input_video: Path, prep_dir: Path) -> Preprocessed:
+    """Run the style-independent stages (decode, face landmarks, depth).
+
+    Face landmarks and depth only depend on the decoded frames and the
+    keyframe selection, so they run concurrently.
 
     Args:
         input_video: Path to input face-scan MP4.
-        output_video: Path for final output MP4.
-        style_id: One of "beauty-realistic", "promptable-avatar", "animated-anime".
-        job_dir: Working directory for intermediate files.
-        seed: Random seed for reproducibility.
+        prep_dir: Working directory for the shared intermediates.
 
     Returns:
-        Path to the output MP4 file.
+        The shared stage outputs.
     """
-    style = get_style(style_id)
-    job_dir.mkdir(parents=True, exist_ok=True)
-    manifest = job_dir / "manifest.json"
+    prep_dir.mkdir(parents=True, exist_ok=True)
+    manifest = prep_dir / "manifest.json"
+    store = prep_dir / "tracks"
+    flow_dir = prep_dir / "flow"
+    lab_stats_path = prep_dir / "lab_stats.npy"
 
     # ── Stage 1: Decode ──
-    frames_dir = job_dir / "frames"
-    if not _stage_done(manifest, "decode"):
-        print("[1/7] Extracting frames...")
-        frame_paths, video_meta = decode.extract_frames(input_video, frames_dir)
+    # Frames go into the "source" track once; every later stage reads views of it.
+    def _decode() -> dict:
+        if _stage_cached(manifest, "decode", store, "source"):
+            print("[1/7] Decode: cached")
+            m = json.loads(manifest.read_text())["decode"]
+            video_meta = decode.VideoMeta(
+                width=m["width"],
+                height=m["height"],
+                fps=m["fps"],
+                duration=m["duration"],
+                frame_count=m["frame_count"],
+            )
+            return {"video_meta": video_meta, "source": frame_store.open_track(store, "source")}
+
+        decode_mode = config.DECODE_MODE
+        print(f"[1/7] Decoding frames ({decode_mode})...")
+        if decode_mode == "png":
+            frame_paths, video_meta = decode.extract_frames(input_video, prep_dir / "frames")
+            frames = decode.load_frames(frame_paths)
+        else:
+            video_meta = decode.probe_video(input_video)
+            frames = decode.iter_frames(input_video, video_meta, config.DECODE_BUFFER_FRAMES)
+        source = frame_store.write_track(store, "source", frames)
+        video_meta.frame_count = len(source)
+        # Cached flow fields and color statistics belong to the previous decode
+        shutil.rmtree(flow_dir, ignore_errors=True)
+        lab_stats_path.unlink(missing_ok=True)
         _mark_done(manifest, "decode", {
+            "mode": decode_mode,
             "fps": video_meta.fps,
             "width": video_meta.width,
             "height": video_meta.height,
             "frame_count": video_meta.frame_count,
             "duration": video_meta.duration,
+            "track": "source",
         })
-    else:
-        print("[1/7] Decode: cached")
-        frame_paths = sorted(frames_dir.glob("frame_*.png"))
-        m = json.loads(manifest.read_text())["decode"]
-        video_meta = decode.VideoMeta(
-            width=m["width"],
-            height=m["height"],
-            fps=m["fps"],
-            duration=m["duration"],
-            frame_count=m["frame_count"],
-        )
+        return {"video_meta": video_meta, "source": source}
+
+    # ── Keyframe selection ──
+    # Decided up front so the control-image stages only run on frames that are
+    # actually stylized.
+    keyframe_interval = config.KEYFRAME_INTERVAL
+
+    def _keyframes(source: np.ndarray) -> dict:
+        keyframe_params = {
+            "mode": config.KEYFRAME_MODE,
+            "interval": keyframe_interval,
+            "budget": config.KEYFRAME_BUDGET,
+            "max_motion": config.KEYFRAME_MAX_MOTION,
+            "max_gap": config.KEYFRAME_MAX_GAP,
+        }
+        # Reused only if selected with the same settings from the current decode
+        m = json.loads(manifest.read_text())
+        cached = m.get("keyframes", {})
+        if (
+            cached.get("done")
+            and cached.get("params") == keyframe_params
+            and cached["timestamp"] >= m["decode"]["timestamp"]
+        ):
+            return {"keyframe_indices": cached["indices"]}
+        keyframe_indices = keyframes.select_keyframes(source, config.KEYFRAME_MODE, keyframe_interval)
+        _mark_done(manifest, "keyframes", {"params": keyframe_params, "indices": keyframe_indices})
+        return {"keyframe_indices": keyframe_indices}
 
     # ── Stage 2: Face Landmarks ──
-    pose_dir = job_dir / "pose"
-    if not _stage_done(manifest, "face_landmarks"):
-        print("[2/7] Detecting face landmarks...")
-        pose_paths = face_landmarks.process_frames(
-            model_path=config.FACE_LANDMARKER_PATH,
-            frame_paths=frame_paths,
-            output_dir=pose_dir,
-            width=video_meta.width,
-            height=video_meta.height,
-        )
-        _mark_done(manifest, "face_landmarks", {"count": len(pose_paths)})
-    else:
-        print("[2/7] Face landmarks: cached")
-        pose_paths = sorted(pose_dir.glob("pose_*.png"))
+    # Raw landmarks only; pose images are rendered by stylize at its resolution.
+    # Runs concurrently with depth estimation (MediaPipe on CPU, DPT on DEVICE).
+    landmarks_path = prep_dir / "landmarks.npz"
+
+    def _face_landmarks(source: np.ndarray, video_meta, keyframe_indices: list[int]) -> dict:
+        num_frames = video_meta.frame_count
+        if not _landmarks_cached(manifest, landmarks_path, keyframe_indices):
+            print(f"[2/7] Detecting face landmarks ({len(keyframe_indices)}/{num_frames} frames)...")
+            detected = face_landmarks.process_frames(
+                model_path=config.FACE_LANDMARKER_PATH,
+                frames=source,
+                indices=keyframe_indices,
+                output_path=landmarks_path,
+                fps=video_meta.fps if config.LANDMARK_TRACKING else None,
+            )
+            _mark_done(manifest, "face_landmarks", {
+                "count": len(keyframe_indices),
+                "detected": detected,
+                "keyframe_interval": keyframe_interval,
+                "output": landmarks_path.name,
+            })
+        else:
+            print("[2/7] Face landmarks: cached")
+        landmarks, face_detected, landmark_indices = face_landmarks.load_landmarks(landmarks_path)
+        return {
+            "landmarks": landmarks,
+            "face_detected": face_detected,
+            "landmark_indices": landmark_indices,
+        }
 
     # ── Stage 3: Depth Estimation ──
-    depth_dir = job_dir / "depth"
-    if not _stage_done(manifest, "depth_estimation"):
-        print("[3/7] Estimating depth maps...")
-        depth_paths = depth_estimation.process_frames(
-            model_id=config.DEPTH_MODEL_ID,
-            device=config.DEVICE,
-            frame_paths=frame_paths,
-            output_dir=depth_dir,
-        )
-        _mark_done(manifest, "depth_estimation", {"count": len(depth_paths)})
-    else:
-        print("[3/7] Depth estimation: cached")
-        depth_paths = sorted(depth_dir.glob("depth_*.png"))
+    def _depth_estimation(source: np.ndarray, video_meta, keyframe_indices: list[int]) -> dict:
+        num_frames = video_meta.frame_count
+        if not _controls_cached(manifest, "depth_estimation", store, "depth", keyframe_indices):
+            print(f"[3/7] Estimating depth maps ({len(keyframe_indices)}/{num_frames} frames)...")
+            # Sized from the track it indexes, not the probed metadata
+            height, width = source.shape[1:3]
+            depth = frame_store.create_track(
+                store, "depth", len(keyframe_indices), height, width,
+                channels=1, indices=keyframe_indices,
+            )
+            count = depth_estimation.process_frames(
+                model_id=config.DEPTH_MODEL_ID,
+                device=config.DEVICE,
+                frames=source,
+                indices=keyframe_indices,
+                out=depth,
+                batch_size=config.DEPTH_BATCH_SIZE,
+                backend=config.DEPTH_BACKEND,
+            )
+            _mark_done(manifest, "depth_estimation", {
+                "count": count,
+                "backend": config.DEPTH_BACKEND,
+                "keyframe_interval": keyframe_interval,
+                "track": "depth",
+            })
+        else:
+            print("[3/7] Depth estimation: cached")
+            depth = frame_store.open_track(store, "depth")
+        return {"depth": depth, "depth_indices": frame_store.track_meta(store, "depth")["indices"]}
 
-    # ── Stage 4: Stylize (keyframes only if interval > 1) ──
-    keyframe_interval = config.KEYFRAME_INTERVAL
-    use_keyframes = keyframe_interval > 1
+    controls_inputs = ("source", "video_meta", "keyframe_indices")
+    v = scheduler.run([
+        scheduler.Stage("decode", _decode, outputs=("video_meta", "source")),
+        scheduler.Stage("keyframes", _keyframes, ("source",), ("keyframe_indices",)),
+        scheduler.Stage(
+            "face_landmarks", _face_landmarks, controls_inputs,
+            ("landmarks", "face_detected", "landmark_indices"),
+        ),
+        scheduler.Stage(
+            "depth_estimation", _depth_estimation, controls_inputs,
+            ("depth", "depth_indices"),
+        ),
+    ], workers=config.STAGE_WORKERS)
+
+    m = json.loads(manifest.read_text())
+    return Preprocessed(
+        video_meta=v["video_meta"],
+        source=v["source"],
+        keyframe_interval=keyframe_interval,
+        keyframe_indices=v["keyframe_indices"],
+        landmarks=v["landmarks"],
+        face_detected=v["face_detected"],
+        landmark_indices=v["landmark_indices"],
+        depth=v["depth"],
+        depth_indices=v["depth_indices"],
+        flow_dir=flow_dir,
+        lab_stats_path=lab_stats_path,
+        fingerprint={
+            name: m[name]["timestamp"]
+            for name in ("decode", "keyframes", "face_landmarks", "depth_estimation")
+        },
+    )
+
+
+def _reference_stats(prep: Preprocessed) -> np.ndarray:
+    """Source LAB statistics for color transfer, computed once per job."""
+    if prep.lab_stats_path.exists():
+        stats = np.load(prep.lab_stats_path)
+        if len(stats) == len(prep.source):
+            return stats
+    stats = postprocess.reference_stats(prep.source)
+    np.save(prep.lab_stats_path, stats)
+    return stats
+
+
+def _refine(prep: Preprocessed, style, style_dir: Path, seed: int) -> dict:
+    """Stylize extra keyframes in the gaps with the highest interpolation
+    error (up to config.REFINE_MAX_KEYFRAMES) and re-interpolate those gaps.
+
+    Face landmarks and depth for the extra frames go into style_dir, so the
+    shared preprocessing outputs stay untouched."""
+    store = style_dir / "tracks"
+    source = prep.source
+    errors = interpolate.interpolation_errors(source, prep.keyframe_indices, prep.flow_dir)
+    extra = interpolate.select_refinements(
+        errors, prep.keyframe_indices,
+        threshold=config.REFINE_ERROR_THRESHOLD,
+        max_keyframes=config.REFINE_MAX_KEYFRAMES,
+    )
+    stats = {
+        "max_error": float(errors.max()),
+        "mean_error": float(errors.mean()),
+        "extra_keyframes": extra,
+    }
+    if not extra:
+        print(f"  No gaps above error {config.REFINE_ERROR_THRESHOLD} (max {stats['max_error']:.1f})")
+        return stats
+    print(f"  {len(extra)} extra keyframes (max error {stats['max_error']:.1f})")
+
+    landmarks_path = style_dir / "refine_landmarks.npz"
+    face_landmarks.process_frames(
+        model_path=config.FACE_LANDMARKER_PATH,
+        frames=source,
+        indices=extra,
+        output_path=landmarks_path,
+        fps=prep.video_meta.fps if config.LANDMARK_TRACKING else None,
+    )
+    landmarks, detected, landmark_indices = face_landmarks.load_landmarks(landmarks_path)
+    height, width = source.shape[1:3]
+    depth = frame_store.create_track(
+        store, "refine_depth", len(extra), height, width,
+        channels=1, indices=extra,
+    )
+    depth_estimation.process_frames(
+        model_id=config.DEPTH_MODEL_ID,
+        device=config.DEVICE,
+        frames=source,
+        indices=extra,
+        out=depth,
+        batch_size=config.DEPTH_BATCH_SIZE,
+        backend=config.DEPTH_BACKEND,
+    )
+
+    styled = frame_store.open_track(store, "styled", writable=True)
+    stylize.process_frames(
+        # Extra keyframes are far apart: no warm start chain between them
+        style=dataclasses.replace(style, warm_start_blend=0.0),
+        device=config.DEVICE,
+        dtype=config.DTYPE,
+        frames=source,
+        landmarks=landmarks,
+        detected=detected,
+        depth=depth,
+        landmark_indices=landmark_indices,
+        depth_indices=extra,
+        frame_indices=extra,
+        out=styled,
+        seed=seed,
+    )
+    keyframe_indices = sorted(set(prep.keyframe_indices) | set(extra))
+    stats["count"] = interpolate.refill_gaps(
+        styled, keyframe_indices, extra, source, prep.flow_dir
+    )
+    return stats
+
+
+def render_style(
+    prep: Preprocessed,
+    style_id: str,
+    style_dir: Path,
+    output_video: Path,
+    seed: int = 42,
+    on_playlist: Callable[[Path], None] = None,
+) -> Path:
+    """Run the per-style stages (stylize, interpolate, postprocess, encode)
+    on preprocessed inputs.
+
+    Args:
+        prep: Output of `preprocess`.
+        style_id: One of "beauty-realistic", "promptable-avatar", "animated-anime".
+        style_dir: Working directory for this style's intermediates.
+        output_video: Path for final output MP4.
+        seed: Random seed for reproducibility.
+        on_playlist: Called with the HLS playlist path once playback can
+            start (config.PROGRESSIVE_OUTPUT).
+
+    Returns:
+        Path to the output MP4 file.
+    """
+    style = get_style(style_id)
+    style_dir.mkdir(parents=True, exist_ok=True)
+    manifest = style_dir / "manifest.json"
+    store = style_dir / "tracks"
+
+    # Results derived from an older preprocessing run are stale
+    if not _stage_done(manifest, "preprocess") or (
+        json.loads(manifest.read_text())["preprocess"].get("fingerprint") != prep.fingerprint
+    ):
+        _reset_stages(manifest, ("stylize", "interpolate", "refine", "postprocess", "encode"))
+        _mark_done(manifest, "preprocess", {"fingerprint": prep.fingerprint})
+
+    video_meta = prep.video_meta
+    source = prep.source
+    num_frames = video_meta.frame_count
+    keyframe_interval = prep.keyframe_interval
+    keyframe_indices = prep.keyframe_indices
+    use_keyframes = len(keyframe_indices) < num_frames
 
     if use_keyframes:
-        # Select keyframes
-        keyframe_indices = list(range(0, len(frame_paths), keyframe_interval))
-        keyframe_frames = [frame_paths[i] for i in keyframe_indices]
-        keyframe_pose = [pose_paths[i] for i in keyframe_indices]
-        keyframe_depth = [depth_paths[i] for i in keyframe_indices]
-        styled_dir = job_dir / "styled_keyframes"
-        stage_label = f"[4/7] Stylizing keyframes (1 in {keyframe_interval}) with '{style.display_name}'..."
+        stage_label = (
+            f"[4/7] Stylizing {len(keyframe_indices)}/{num_frames} keyframes "
+            f"({config.KEYFRAME_MODE}) with '{style.display_name}'..."
+        )
     else:
-        # Process all frames
-        keyframe_frames = frame_paths
-        keyframe_pose = pose_paths
-        keyframe_depth = depth_paths
-        styled_dir = job_dir / "styled"
         stage_label = f"[4/7] Stylizing all frames with '{style.display_name}'..."
 
-    if not _stage_done(manifest, "stylize"):
+    # A refined styled track holds the extra keyframes of its settings: other
+    # settings (including refine now off) start again from a fresh interpolation
+    refine = use_keyframes and config.REFINE_MAX_KEYFRAMES > 0
+    refine_params = {
+        "max_keyframes": config.REFINE_MAX_KEYFRAMES if refine else 0,
+        "error_threshold": config.REFINE_ERROR_THRESHOLD,
+    }
+    if _stage_done(manifest, "refine") and (
+        json.loads(manifest.read_text())["refine"].get("params") != refine_params
+    ):
+        _reset_stages(manifest, ("interpolate", "refine", "postprocess", "encode"))
+
+    # ── Stage 4: Stylize (keyframes only if interval > 1) ──
+    # The styled track is full length: stylize fills keyframe slots, interpolate the rest
+    stylize_cached = _stage_cached(manifest, "stylize", store, "styled")
+    if not stylize_cached:
         print(stage_label)
-        styled_keyframes = stylize.process_frames(
-            style=style,
-            device=config.DEVICE,
-            dtype=config.DTYPE,
-            frame_paths=keyframe_frames,
-            openpose_paths=keyframe_pose,
-            depth_paths=keyframe_depth,
-            output_dir=styled_dir,
-            seed=seed,
-        )
+        # Everything downstream is built on the styled track
+        _reset_stages(manifest, ("interpolate", "refine", "postprocess", "encode"))
+        source_h, source_w = source.shape[1:3]
+        out_w, out_h = stylize.output_size(source_w, source_h)
+        frame_store.create_track(store, "styled", len(source), out_h, out_w)
+    else:
+        print("[4/7] Stylize: cached")
+
+    # Interpolate gaps as soon as both of their keyframes are stylized,
+    # while the diffusion model works on the next ones (needs two workers)
+    interpolate_done = _stage_done(manifest, "interpolate")
+    stream = (
+        use_keyframes
+        and config.STAGE_WORKERS > 1
+        and not stylize_cached
+        and not interpolate_done
+    )
+    channel = scheduler.Channel(config.STREAM_QUEUE_SIZE) if stream else None
+
+    # Post-process and encode the finished prefix of the styled track while
+    # it is still being filled (one more worker). Not with refine, which
+    # rewrites frames after interpolation, nor with segmented encoding.
+    stream_output = (
+        use_keyframes
+        and not refine
+        and not interpolate_done
+        and _pipe_encode(num_frames)
+        and not _stage_done(manifest, "encode")
+        and config.STAGE_WORKERS > (2 if stream else 1)
+    )
+    ready_channel = scheduler.Channel(config.STREAM_QUEUE_SIZE) if stream_output else None
+
+    def _send(batch: list[int]):
+        for idx in batch:
+            channel.put(idx)
+
+    def _stylize() -> dict:
+        if stylize_cached:
+            return {"stylized": True}
+        # Whatever goes wrong, the interpolate stage must not wait on the channel forever
+        try:
+            styled = frame_store.open_track(store, "styled", writable=True)
+            stats = stylize.process_frames(
+                style=style,
+                device=config.DEVICE,
+                dtype=config.DTYPE,
+                frames=source,
+                landmarks=prep.landmarks,
+                detected=prep.face_detected,
+                depth=prep.depth,
+                landmark_indices=prep.landmark_indices,
+                depth_indices=prep.depth_indices,
+                frame_indices=keyframe_indices,
+                out=styled,
+                seed=seed,
+                on_stored=_send if channel else None,
+            )
+            styled.flush()
+        except BaseException:
+            if channel:
+                channel.fail()
+            raise
+        if channel:
+            channel.close()
         _mark_done(manifest, "stylize", {
-            "count": len(styled_keyframes),
+            **stats,
             "style_id": style_id,
             "keyframe_interval": keyframe_interval,
+            "keyframes": len(keyframe_indices),
+            "face_roi": config.STYLIZE_FACE_ROI,
+            "batch_size": config.STYLIZE_BATCH_SIZE,
+            "track": "styled",
         })
-    else:
-        print("[4/7] Stylize: cached")
-        styled_keyframes = sorted(styled_dir.glob("styled_*.png"))
+        return {"stylized": True}
 
     # ── Stage 4.5: Interpolate (if using keyframes) ──
-    if use_keyframes:
-        interpolated_dir = job_dir / "styled_full"
-        if not _stage_done(manifest, "interpolate"):
-            print(f"[4.5/7] Interpolating {len(frame_paths)} frames from {len(styled_keyframes)} keyframes...")
-            all_frame_indices = list(range(len(frame_paths)))
-            styled_paths = interpolate.process_keyframes(
-                keyframe_paths=styled_keyframes,
-                all_frame_indices=all_frame_indices,
-                keyframe_interval=keyframe_interval,
-                output_dir=interpolated_dir,
+    def _interpolate(**_) -> dict:
+        if not use_keyframes:
+            return {"interpolated": True}
+        # Likewise, a failure here must release a stylize stage blocked on a full channel
+        try:
+            if _stage_done(manifest, "interpolate"):
+                print("[4.5/7] Interpolate: cached")
+                return {"interpolated": True}
+            streamed = " (streamed)" if channel else ""
+            print(f"[4.5/7] Interpolating {num_frames} frames from {len(keyframe_indices)} keyframes{streamed}...")
+            styled = frame_store.open_track(store, "styled", writable=True)
+            count = interpolate.process_keyframes(
+                frames=styled,
+                keyframe_indices=keyframe_indices,
+                source=source,
+                flow_dir=prep.flow_dir,
+                completed=iter(channel) if channel else None,
+                on_ready=ready_channel.put if ready_channel else None,
+            )
+        except BaseException:
+            if channel:
+                channel.cancel()
+            if ready_channel:
+                ready_channel.fail()
+            raise
+        if ready_channel:
+            ready_channel.close()
+        _mark_done(manifest, "interpolate", {
+            "count": count,
+            "method": config.INTERPOLATION_METHOD,
+            "streamed": stream,
+        })
+        return {"interpolated": True}
+
+    # ── Stage 4.6: Refine (extra keyframes where interpolation fails) ──
+    def _refine_stage(stylized, interpolated) -> dict:
+        if refine:
+            if not _stage_done(manifest, "refine"):
+                print("[4.6/7] Refining keyframes...")
+                # Output built on the unrefined track is stale
+                _reset_stages(manifest, ("postprocess", "encode"))
+                refine_stats = _refine(prep, style, style_dir, seed)
+                _mark_done(manifest, "refine", {"params": refine_params, **refine_stats})
+            else:
+                print("[4.6/7] Refine: cached")
+        return {"refined": True}
+
+    def _finish(**_) -> dict:
+        try:
+            _postprocess_and_encode(
+                prep, style, manifest, store, output_video, on_playlist,
+                ready=iter(ready_channel) if ready_channel else None,
+            )
+        except BaseException:
+            if ready_channel:
+                ready_channel.cancel()
+            raise
+        return {"output": output_video}
+
+    scheduler.run([
+        scheduler.Stage("stylize", _stylize, outputs=("stylized",)),
+        # Streaming: starts with stylize and consumes its channel
+        scheduler.Stage(
+            "interpolate", _interpolate, () if stream else ("stylized",), ("interpolated",),
+        ),
+        scheduler.Stage("refine", _refine_stage, ("stylized", "interpolated"), ("refined",)),
+        # Streaming: starts right away and consumes interpolate's ready prefix
+        scheduler.Stage(
+            "postprocess_encode", _finish, () if stream_output else ("refined",), ("output",),
+        ),
+    ], workers=config.STAGE_WORKERS)
+
+    print(f"\nDone! Output: {output_video}")
+    return output_video
+
+
+def _pipe_encode(num_frames: int) -> bool:
+    """Post-process streams straight into the encoder (no final track).
+
+    Parallel segment encoders each need their own frame range at the same
+    time, which an in-order stream cannot feed: they encode the final track."""
+    segmented = len(encode.segment_bounds(num_frames, config.ENCODE_SEGMENTS)) > 1
+    return config.ENCODE_MODE == "pipe" and (config.PROGRESSIVE_OUTPUT or not segmented)
+
+
+def _postprocess_and_encode(
+    prep: Preprocessed,
+    style,
+    manifest: Path,
+    store: Path,
+    output_video: Path,
+    on_playlist: Callable[[Path], None] = None,
+    ready: Iterable[int] = None,
+):
+    """Stages 5 + 6 on the styled track (see config.ENCODE_MODE). With
+    `ready` (see postprocess.iter_frames) they consume its finished prefix
+    while interpolation still fills the rest."""
+    video_meta = prep.video_meta
+    source = prep.source
+    styled = frame_store.open_track(store, "styled")
+
+    original_stats = _reference_stats(prep) if style.color_match_strength > 0 else None
+
+    # ── Stages 5 + 6 streamed: post-process straight into the encoder ──
+    if _pipe_encode(len(styled)):
+        if not _stage_done(manifest, "encode"):
+            print("[5/7] Post-processing and encoding (streamed, no final track)...")
+            frames = postprocess.iter_frames(
+                styled=styled,
+                originals=source,
+                color_match_strength=style.color_match_strength,
+                temporal_blend_frames=style.temporal_blend_frames,
+                original_stats=original_stats,
+                ready=ready,
             )
-            _mark_done(manifest, "interpolate", {"count": len(styled_paths)})
+            _, out_h, out_w, _ = styled.shape
+            encode_meta = {}
+            if config.PROGRESSIVE_OUTPUT:
+                hls_dir = output_video.with_name(f"{output_video.stem}_hls")
+                count = encode.encode_progressive(
+                    frames,
+                    width=out_w,
+                    height=out_h,
+                    output_path=output_video,
+                    hls_dir=hls_dir,
+                    fps=video_meta.fps,
+                    total=len(styled),
+                    on_playlist=on_playlist,
+                )
+                encode_meta["playlist"] = str(hls_dir / "playlist.m3u8")
+            else:
+                count = encode.encode_frames(
+                    frames,
+                    width=out_w,
+                    height=out_h,
+                    output_path=output_video,
+                    fps=video_meta.fps,
+                    total=len(styled),
+                )
+            _mark_done(manifest, "postprocess", {"streamed": True})
+            _mark_done(manifest, "encode", {
+                "output": str(output_video), "count": count, **encode_meta,
+            })
         else:
-            print("[4.5/7] Interpolate: cached")
-            styled_paths = sorted(interpolated_dir.glob("frame_*.png"))
-    else:
-        # No interpolation needed
-        styled_paths = styled_keyframes
+            print("[5/7] Post-process + encode: cached")
+        return
 
     # ── Stage 5: Post-process ──
-    final_dir = job_dir / "final"
-    if not _stage_done(manifest, "postprocess"):
+    if not _stage_cached(manifest, "postprocess", store, "final"):
         print("[5/7] Post-processing (color match + temporal smooth)...")
+        final = frame_store.create_track(store, "final", *styled.shape)
         postprocess.process_frames(
-            styled_paths=styled_paths,
-            original_paths=frame_paths,
-            output_dir=final_dir,
+            styled=styled,
+            originals=source,
+            out=final,
             color_match_strength=style.color_match_strength,
             temporal_blend_frames=style.temporal_blend_frames,
+            original_stats=original_stats,
         )
-        _mark_done(manifest, "postprocess")
+        _mark_done(manifest, "postprocess", {"track": "final"})
+        # A new final track needs a new encode
+        _reset_stages(manifest, ("encode",))
     else:
         print("[5/7] Post-process: cached")
 
     # ── Stage 6: Encode ──
     if not _stage_done(manifest, "encode"):
         print("[6/7] Encoding output video...")
-        encode.encode_video(
-            frame_dir=final_dir,
+        final_meta = frame_store.track_meta(store, "final")
+        _, final_h, final_w, _ = final_meta["shape"]
+        encode.encode_track(
+            track_path=frame_store.track_path(store, "final"),
+            width=final_w,
+            height=final_h,
             output_path=output_video,
             fps=video_meta.fps,
+            segments=config.ENCODE_SEGMENTS,
         )
         _mark_done(manifest, "encode", {"output": str(output_video)})
     else:
         print("[6/7] Encode: cached")
 
-    print(f"\nDone! Output: {output_video}")
-    return output_video
+
+def run(
+    input_video: Path,
+    output_video: Path,
+    style_id: str,
+    job_dir: Path,
+    seed: int = 42,
+    on_playlist: Callable[[Path], None] = None,
+) -> Path:
+    """Run the complete Output A pipeline.
+
+    Args:
+        input_video: Path to input face-scan MP4.
+        output_video: Path for final output MP4.
+        style_id: One of "beauty-realistic", "promptable-avatar", "animated-anime".
+        job_dir: Working directory for intermediate files.
+        seed: Random seed for reproducibility.
+        on_playlist: See render_style.
+
+    Returns:
+        Path to the output MP4 file.
+    """
+    prep = preprocess(input_video, job_dir)
+    return render_style(prep, style_id, job_dir, output_video, seed, on_playlist)
+
+
+def run_multi(
+    input_video: Path,
+    output_videos: dict[str, Path],
+    job_dir: Path,
+    seed: int = 42,
+    on_playlist: Callable[[str, Path], None] = None,
+) -> dict[str, Path]:
+    """Run the pipeline for several styles of the same video.
+
+    Decode, face landmarks and depth run once into job_dir/shared; only
+    stylize -> interpolate -> postprocess -> encode run per style, each in
+    job_dir/<style_id> with its own manifest.
+
+    Args:
+        input_video: Path to input face-scan MP4.
+        output_videos: Output MP4 path per style ID.
+        job_dir: Working directory for intermediate files.
+        seed: Random seed for reproducibility.
+        on_playlist: Called with (style ID, HLS playlist path) once each
+            style's playback can start (config.PROGRESSIVE_OUTPUT).
+
+    Returns:
+        Output MP4 path per style ID.
+    """
+    for style_id in output_videos:
+        get_style(style_id)  # Fail fast on unknown styles
+
+    prep = preprocess(input_video, job_dir / "shared")
+    results = {}
+    for style_id, output_video in output_videos.items():
+        print(f"\n── Style: {style_id} ──")
+        results[style_id] = render_style(
+            prep, style_id, job_dir / style_id, output_video, seed,
+            on_playlist=(lambda path, s=style_id: on_playlist(s, path)) if on_playlist else None,
+        )
+    return results
@@ -0,0 +1,82 @@
+"""Content-addressed cache of stylized keyframes on the persistent volume.
+
+The key hashes everything that determines a diffusion result: the exact
+source / pose / depth images fed to the pipeline plus the generation
+parameters (diffusion style fields, seed, steps, LCM, dtype, ControlNet
+models, resolution). Re-running a job at another tier or re-submitting the
+same upload then reuses every frame whose inputs did not change.
+
+Entries are PNG files under config.RESULT_CACHE_DIR; reads refresh the
+file mtime and `trim` deletes the least recently used entries beyond
+config.RESULT_CACHE_MB.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+
+def result_key(images: list[Image.Image], params: dict) -> str:
+    """Hex digest identifying one diffusion result."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    for img in images:
+        arr = np.asarray(img)
+        h.update(f"{img.mode}{arr.shape}".encode())
+        h.update(np.ascontiguousarray(arr).data)
+    return h.hexdigest()
+
+
+def _entry_path(key: str) -> Path:
+    import config
+
+    return Path(config.RESULT_CACHE_DIR) / key[:2] / f"{key}.png"
+
+
+def get(key: str) -> Image.Image:
+    """Cached image for `key`, or None."""
+    path = _entry_path(key)
+    try:
+        with Image.open(path) as img:
+            result = img.convert("RGB")
+    except (FileNotFoundError, OSError):
+        return None
+    os.utime(path)  # Mark as recently used
+    return result
+
+
+def put(key: str, image: Image.Image):
+    """Store an image under `key` (atomic write)."""
+    path = _entry_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Not *.png, so trim never evicts an entry that is still being written
+    tmp_path = path.with_suffix(".png.tmp")
+    image.save(tmp_path, format="PNG")
+    tmp_path.replace(path)
+
+
+def trim(max_mb: float):
+    """Delete least recently used entries until the cache fits in `max_mb`."""
+    import config
+
+    root = Path(config.RESULT_CACHE_DIR)
+    if max_mb <= 0 or not root.exists():
+        return
+    entries = []
+    for path in root.glob("*/*.png"):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    budget = max_mb * 1024 ** 2
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
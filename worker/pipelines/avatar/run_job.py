@@ -1,5 +1,33 @@
 from pathlib import Path
 from pipelines.avatar import output_a_video
+from pipelines.avatar.io.http_client import BackendClient
+import config
+
+
+def playlist_url(playlist: Path, output_dir: Path) -> str:
+    """Public URL of an HLS playlist written under `output_dir`
+    (config.OUTPUT_BASE_URL must be set)."""
+    relative = playlist.resolve().relative_to(output_dir.resolve())
+    return f"{config.OUTPUT_BASE_URL.rstrip('/')}/{relative.as_posix()}"
+
+
+def _playlist_reporter(backend_job_id: str, style_id: str, output_dir: Path):
+    """Callback that tells the backend where a style's playlist is, or None
+    when there is nothing to report: progressive output off, no backend job,
+    or no public URL for the output directory."""
+    if not config.PROGRESSIVE_OUTPUT or not backend_job_id:
+        return None
+    if not config.OUTPUT_BASE_URL:
+        print("  OUTPUT_BASE_URL not set, playlist URL not reported")
+        return None
+    client = BackendClient(config.BACKEND_URL)
+
+    def _report(playlist: Path):
+        url = playlist_url(playlist, output_dir)
+        print(f"  Progressive playlist: {url}")
+        client.update_job_status(backend_job_id, "running", playlist_url=url, style_id=style_id)
+
+    return _report
 
 
 def dispatch(
@@ -10,6 +38,7 @@ def dispatch(
     style_id: str,
     job_dir: str,
     seed: int = 42,
+    backend_job_id: str = None,
 ):
     """Dispatch a job to the correct pipeline.
 
@@ -21,6 +50,8 @@ def dispatch(
         style_id: Style identifier.
         job_dir: Working directory for intermediates.
         seed: Random seed.
+        backend_job_id: Job ID issued by the backend, for progress reports
+            (None = local run, nothing reported).
     """
     if pipeline == "output_a":
         return output_a_video.run(
@@ -29,6 +60,46 @@ def dispatch(
             style_id=style_id,
             job_dir=Path(job_dir),
             seed=seed,
+            on_playlist=_playlist_reporter(backend_job_id, style_id, Path(output_video).parent),
+        )
+    else:
+        raise ValueError(f"Unknown pipeline: {pipeline}")
+
+
+def dispatch_multi(
+    job_id: str,
+    pipeline: str,
+    input_video: str,
+    output_videos: dict[str, str],
+    job_dir: str,
+    seed: int = 42,
+    backend_job_id: str = None,
+):
+    """Dispatch a job that renders several styles of one input video.
+
+    Args:
+        job_id: Unique job identifier.
+        pipeline: Pipeline name ("output_a" for now).
+        input_video: Path to input MP4.
+        output_videos: Output MP4 path per style identifier.
+        job_dir: Working directory for intermediates (shared + per style).
+        seed: Random seed.
+        backend_job_id: See dispatch; playlists are reported per style.
+    """
+    if pipeline == "output_a":
+        outputs = {s: Path(p) for s, p in output_videos.items()}
+        reporters = {
+            s: _playlist_reporter(backend_job_id, s, p.parent) for s, p in outputs.items()
+        }
+        return output_a_video.run_multi(
+            input_video=Path(input_video),
+            output_videos=outputs,
+            job_dir=Path(job_dir),
+            seed=seed,
+            on_playlist=(
+                (lambda style_id, path: reporters[style_id](path))
+                if any(reporters.values()) else None
+            ),
         )
     else:
         raise ValueError(f"Unknown pipeline: {pipeline}")
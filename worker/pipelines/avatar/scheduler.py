@@ -0,0 +1,150 @@
+"""Small DAG / stream scheduler for the Output A stages.
+
+Stages declare the named values they consume and produce. `run` starts
+every stage as soon as all of its inputs exist, so independent stages (face
+landmarks on the CPU, depth on the GPU) run concurrently on a thread pool.
+Frame-level producer / consumer pairs run as two concurrent stages joined
+by a bounded `Channel`. Caching stays inside the stage functions, which
+keep checking the manifest as before.
+"""
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+
+@dataclass
+class Stage:
+    """One node of the stage graph.
+
+    `fn` is called with the `inputs` as keyword arguments and returns a dict
+    with exactly the `outputs` keys."""
+    name: str
+    fn: Callable[..., dict]
+    inputs: tuple[str, ...] = ()
+    outputs: tuple[str, ...] = ()
+
+
+def run(stages: list[Stage], values: dict = None, workers: int = 2) -> dict:
+    """Run `stages` in dependency order, independent ones concurrently.
+
+    Args:
+        stages: Stage graph; each output name must be produced by one stage
+        values: Initial values (inputs no stage produces)
+        workers: Max stages running at once
+
+    Returns:
+        All initial and produced values by name.
+
+    Raises the first stage error, after the stages already running have
+    finished (threads cannot be interrupted; Channels let them stop early).
+    """
+    values = dict(values or {})
+    producers = {}
+    for stage in stages:
+        for name in stage.outputs:
+            if name in producers or name in values:
+                raise ValueError(f"Value '{name}' is produced twice ({stage.name})")
+            producers[name] = stage.name
+    for stage in stages:
+        missing = [n for n in stage.inputs if n not in producers and n not in values]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' needs unknown inputs {missing}")
+
+    pending = list(stages)
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        while pending or running:
+            if error is None:
+                for stage in [s for s in pending if all(n in values for n in s.inputs)]:
+                    if len(running) >= max(1, workers):
+                        break
+                    pending.remove(stage)
+                    kwargs = {n: values[n] for n in stage.inputs}
+                    running[pool.submit(stage.fn, **kwargs)] = stage
+            if not running:
+                if error is None and pending:
+                    raise ValueError(f"Stage graph has a cycle: {[s.name for s in pending]}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    result = future.result()
+                except BaseException as e:
+                    # A closed channel is the consequence of the other side's
+                    # failure: report that one instead
+                    if error is None or isinstance(error, ChannelClosed):
+                        error = e
+                    continue
+                if set(result or {}) != set(stage.outputs):
+                    error = error or ValueError(
+                        f"Stage '{stage.name}' returned {sorted(result or {})}, "
+                        f"declared {list(stage.outputs)}"
+                    )
+                    continue
+                values.update(result or {})
+    if error is not None:
+        raise error
+    return values
+
+
+class ChannelClosed(Exception):
+    """The other side of a Channel stopped (failed or gave up)."""
+
+
+class Channel:
+    """Bounded queue from one producer stage to one consumer stage.
+
+    The producer `put`s items and then `close`s (or `fail`s on error); the
+    consumer iterates until the channel is closed, and `cancel`s if it
+    stops early, so a blocked producer never waits forever.
+    """
+
+    _END = object()
+    _FAILED = object()
+
+    def __init__(self, maxsize: int):
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, maxsize))
+        self._cancelled = threading.Event()
+
+    def _put(self, item: Any):
+        while True:
+            if self._cancelled.is_set():
+                raise ChannelClosed("consumer stopped")
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def put(self, item: Any):
+        """Send one item, blocking while the channel is full."""
+        self._put(item)
+
+    def close(self):
+        """Producer finished successfully."""
+        self._put(self._END)
+
+    def fail(self):
+        """Producer failed; the consumer raises ChannelClosed."""
+        try:
+            self._put(self._FAILED)
+        except ChannelClosed:
+            pass
+
+    def cancel(self):
+        """Consumer stopped early; the producer's next put raises."""
+        self._cancelled.set()
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if item is self._FAILED:
+                raise ChannelClosed("producer failed")
+            yield item
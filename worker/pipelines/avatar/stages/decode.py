@@ -1,7 +1,13 @@
 import json
+import queue
 import subprocess
+import threading
 from pathlib import Path
 from dataclasses import dataclass
+from typing import Iterator
+
+import cv2
+import numpy as np
 
 
 @dataclass
@@ -13,8 +19,20 @@ class VideoMeta:
     frame_count: int
 
 
+def _rotation(vstream: dict) -> int:
+    """Display rotation in degrees from the stream's display matrix side
+    data, or the legacy `rotate` tag (0 if neither is present)."""
+    for side_data in vstream.get("side_data_list", []):
+        if "rotation" in side_data:
+            return int(round(float(side_data["rotation"])))
+    return int(vstream.get("tags", {}).get("rotate", 0))
+
+
 def probe_video(video_path: Path) -> VideoMeta:
-    """Use ffprobe to get video metadata (fps, resolution, duration)."""
+    """Use ffprobe to get video metadata (fps, resolution, duration).
+
+    ffmpeg autorotates on decode, so width and height are those of the
+    decoded (display-oriented) frames: swapped for 90/270 degree rotations."""
     cmd = [
         "ffprobe", "-v", "quiet",
         "-print_format", "json",
@@ -27,9 +45,12 @@ def probe_video(video_path: Path) -> VideoMeta:
     num, den = map(int, vstream["r_frame_rate"].split("/"))
     fps = num / den
     duration = float(info["format"]["duration"])
+    width, height = int(vstream["width"]), int(vstream["height"])
+    if _rotation(vstream) % 180:
+        width, height = height, width
     return VideoMeta(
-        width=int(vstream["width"]),
-        height=int(vstream["height"]),
+        width=width,
+        height=height,
         fps=fps,
         duration=duration,
         frame_count=int(fps * duration),
@@ -52,3 +73,96 @@ def extract_frames(video_path: Path, output_dir: Path) -> tuple[list[Path], Vide
     frames = sorted(output_dir.glob("frame_*.png"))
     meta.frame_count = len(frames)
     return frames, meta
+
+
+def iter_frames(
+    video_path: Path,
+    meta: VideoMeta,
+    buffer_frames: int = 8,
+) -> Iterator[np.ndarray]:
+    """Decode frames straight from an ffmpeg rawvideo pipe.
+
+    Yields read-only (H, W, 3) uint8 RGB arrays in presentation order without
+    writing anything to disk. A reader thread keeps at most `buffer_frames` decoded
+    frames queued ahead of the consumer.
+    """
+    cmd = [
+        "ffmpeg", "-v", "error",
+        "-i", str(video_path),
+        "-vf", f"fps={meta.fps}",
+        "-vsync", "vfr",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "pipe:1",
+    ]
+    frame_bytes = meta.width * meta.height * 3
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=frame_bytes
+    )
+    # Drain stderr on a thread: a noisy decode must not block ffmpeg on a full pipe
+    stderr_chunks = []
+    stderr_reader = threading.Thread(
+        target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True
+    )
+    stderr_reader.start()
+    frames: queue.Queue = queue.Queue(maxsize=max(1, buffer_frames))
+    stop = threading.Event()
+    _END = object()
+    trailing = 0  # Bytes of an incomplete last frame
+
+    def _reader():
+        nonlocal trailing
+        try:
+            while not stop.is_set():
+                buf = proc.stdout.read(frame_bytes)
+                if len(buf) < frame_bytes:
+                    trailing = len(buf)
+                    break
+                frame = np.frombuffer(buf, dtype=np.uint8).reshape(
+                    meta.height, meta.width, 3
+                )
+                frames.put(frame)
+        finally:
+            frames.put(_END)
+
+    reader = threading.Thread(target=_reader, daemon=True)
+    reader.start()
+    try:
+        while True:
+            frame = frames.get()
+            if frame is _END:
+                break
+            yield frame
+    finally:
+        # Unblock the reader (it may be waiting on a full queue) and reap ffmpeg,
+        # also when the consumer stops iterating early.
+        stop.set()
+        while reader.is_alive():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                reader.join(timeout=0.1)
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        returncode = proc.wait()
+        stderr_reader.join()
+        stderr = b"".join(stderr_chunks).decode(errors="replace")
+        proc.stderr.close()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+    if trailing:
+        # The stream is not a whole number of frames: the probed size is wrong
+        raise ValueError(
+            f"Decoded stream of {video_path} does not match the probed "
+            f"{meta.width}x{meta.height} frame size ({trailing} trailing bytes)"
+        )
+
+
+def load_frames(frame_paths: list[Path]) -> Iterator[np.ndarray]:
+    """Read extracted PNG frames back as (H, W, 3) uint8 RGB arrays."""
+    for fp in frame_paths:
+        bgr = cv2.imread(str(fp))
+        yield cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
@@ -1,65 +1,244 @@
+import json
 import torch
 import numpy as np
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from types import SimpleNamespace
 from transformers import DPTForDepthEstimation, DPTImageProcessor
 
 
-def load_depth_model(model_id: str, device: str):
-    """Load MiDaS depth estimation model."""
+class OnnxDepthModel:
+    """DPT exported to ONNX and run with ONNX Runtime on CPU.
+
+    Called like the transformers model (`model(pixel_values=...)`) and
+    returns an object with `predicted_depth`, so `_predict_depth` works
+    with either backend."""
+
+    def __init__(self, onnx_path: Path, num_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads  # 0 = one per physical core
+        options.inter_op_num_threads = 1
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(
+            str(onnx_path), options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, pixel_values: torch.Tensor):
+        (depth,) = self.session.run(
+            ["predicted_depth"], {"pixel_values": pixel_values.cpu().numpy()}
+        )
+        return SimpleNamespace(predicted_depth=torch.from_numpy(depth))
+
+
+class _PredictedDepth(torch.nn.Module):
+    """Export wrapper: plain tensor output instead of a ModelOutput."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).predicted_depth
+
+
+def onnx_export_path(model_id: str, quantize: bool) -> Path:
+    """Cache location of the ONNX export of `model_id` under MODELS_DIR."""
+    import config
+
+    suffix = "-int8" if quantize else ""
+    return config.MODELS_DIR / "depth_onnx" / f"{model_id.replace('/', '--')}{suffix}.onnx"
+
+
+def export_onnx(model_id: str, quantize: bool = False) -> Path:
+    """Export the DPT model to ONNX once (optionally dynamic-int8 quantized).
+    Returns the cached path; an existing export is reused."""
+    onnx_path = onnx_export_path(model_id, quantize)
+    if onnx_path.exists():
+        return onnx_path
+    onnx_path.parent.mkdir(parents=True, exist_ok=True)
+
+    fp32_path = onnx_export_path(model_id, quantize=False)
+    if not fp32_path.exists():
+        print(f"  Exporting {model_id} to ONNX ({fp32_path.name})...")
+        processor = DPTImageProcessor.from_pretrained(model_id)
+        model = DPTForDepthEstimation.from_pretrained(model_id).eval()
+        dummy = processor(
+            images=np.zeros((384, 384, 3), dtype=np.uint8), return_tensors="pt"
+        )["pixel_values"]
+        tmp_path = fp32_path.with_suffix(".onnx.tmp")
+        with torch.no_grad():
+            torch.onnx.export(
+                _PredictedDepth(model),
+                (dummy,),
+                str(tmp_path),
+                input_names=["pixel_values"],
+                output_names=["predicted_depth"],
+                dynamic_axes={
+                    "pixel_values": {0: "batch", 2: "height", 3: "width"},
+                    "predicted_depth": {0: "batch", 1: "height", 2: "width"},
+                },
+                opset_version=17,
+            )
+        tmp_path.rename(fp32_path)
+        del model
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f"  Quantizing depth model to int8 ({onnx_path.name})...")
+        quantize_dynamic(str(fp32_path), str(onnx_path), weight_type=QuantType.QInt8)
+    return onnx_path
+
+
+def check_parity(
+    processor,
+    reference_model,
+    candidate_model,
+    frames: list[np.ndarray],
+    tolerance: float,
+) -> dict:
+    """Compare normalized depth maps of a candidate backend against the torch
+    reference on the same frames. Passes if the mean absolute difference
+    (in 0-255 depth levels) is within `tolerance`."""
+    inputs = processor(images=frames, return_tensors="pt")
+    size = frames[0].shape[:2]
+    reference = _predict_depth(reference_model, inputs, size, "cpu").astype(np.int16)
+    candidate = _predict_depth(candidate_model, inputs, size, "cpu").astype(np.int16)
+    diff = np.abs(reference - candidate)
+    mean_abs_diff = float(diff.mean())
+    return {
+        "frames": len(frames),
+        "mean_abs_diff": mean_abs_diff,
+        "max_abs_diff": int(diff.max()),
+        "tolerance": tolerance,
+        "passed": mean_abs_diff <= tolerance,
+    }
+
+
+def load_depth_model(model_id: str, device: str, backend: str = "torch"):
+    """Load MiDaS depth estimation model.
+
+    backend="torch" loads the transformers model on `device`; backend="onnx"
+    loads (exporting on first use) the ONNX Runtime CPU model."""
+    import config
+
     processor = DPTImageProcessor.from_pretrained(model_id)
+    if backend == "onnx":
+        onnx_path = export_onnx(model_id, quantize=config.DEPTH_ONNX_QUANTIZE)
+        model = OnnxDepthModel(onnx_path, num_threads=config.DEPTH_CPU_THREADS)
+        print(f"  Depth backend: ONNX Runtime ({onnx_path.name})")
+        return processor, model
+    if backend != "torch":
+        raise ValueError(f"Unknown depth backend '{backend}'. Options: torch, onnx")
+
+    if device == "cpu" and config.DEPTH_CPU_THREADS > 0:
+        torch.set_num_threads(config.DEPTH_CPU_THREADS)
     model = DPTForDepthEstimation.from_pretrained(model_id)
     model.to(device)
     model.eval()
     return processor, model
 
 
-def estimate_depth(
-    processor,
-    model,
-    image: Image.Image,
-    device: str,
-) -> Image.Image:
-    """Estimate depth for a single image, return as grayscale PIL Image."""
-    inputs = processor(images=image, return_tensors="pt").to(device)
+def _verified_backend(processor, model, model_id: str, sample: list[np.ndarray]):
+    """Run the parity check once per ONNX export (cached next to it).
+    Returns the model to use: the ONNX one, or the torch reference on failure."""
+    import config
+
+    report_path = model.onnx_path.with_suffix(".parity.json")
+    if report_path.exists():
+        report = json.loads(report_path.read_text())
+        reference = None
+    else:
+        print("  Checking ONNX depth parity against the torch model...")
+        reference = DPTForDepthEstimation.from_pretrained(model_id).eval()
+        report = check_parity(
+            processor, reference, model, sample, config.DEPTH_PARITY_TOLERANCE
+        )
+        report_path.write_text(json.dumps(report, indent=2))
+        print(
+            f"  Parity: mean |diff| {report['mean_abs_diff']:.2f}, "
+            f"max {report['max_abs_diff']} ({'ok' if report['passed'] else 'FAILED'})"
+        )
+
+    if report["passed"]:
+        return model
+    print(f"  Warning: {model.onnx_path.name} failed parity, using torch backend")
+    return reference if reference is not None else load_depth_model(model_id, "cpu")[1]
+
+
+def _predict_depth(model, inputs, size: tuple[int, int], device: str) -> np.ndarray:
+    """Run DPT on preprocessed inputs and return (B, H, W) uint8 depth maps,
+    each min/max normalized to 0-255. Upsampling and normalization run as
+    batched tensor ops with a single device -> host copy at the end."""
+    inputs = inputs.to(device)
     with torch.no_grad():
         outputs = model(**inputs)
         predicted_depth = outputs.predicted_depth
 
     prediction = torch.nn.functional.interpolate(
         predicted_depth.unsqueeze(1),
-        size=image.size[::-1],  # (H, W)
+        size=size,  # (H, W)
         mode="bicubic",
         align_corners=False,
-    ).squeeze()
+    ).squeeze(1)
 
-    depth_np = prediction.cpu().numpy()
-    depth_min, depth_max = depth_np.min(), depth_np.max()
-    if depth_max - depth_min > 0:
-        depth_np = (depth_np - depth_min) / (depth_max - depth_min) * 255.0
-    else:
-        depth_np = np.zeros_like(depth_np)
-    return Image.fromarray(depth_np.astype(np.uint8))
+    flat = prediction.flatten(1)
+    depth_min = flat.min(dim=1).values[:, None, None]
+    depth_max = flat.max(dim=1).values[:, None, None]
+    depth_range = depth_max - depth_min
+    normalized = torch.where(
+        depth_range > 0,
+        (prediction - depth_min) / depth_range.clamp(min=1e-12) * 255.0,
+        torch.zeros_like(prediction),
+    )
+    return normalized.to(torch.uint8).cpu().numpy()
 
 
 def process_frames(
     model_id: str,
     device: str,
-    frame_paths: list[Path],
-    output_dir: Path,
-) -> list[Path]:
-    """Generate depth maps for all frames."""
-    output_dir.mkdir(parents=True, exist_ok=True)
-    processor, model = load_depth_model(model_id, device)
-    depth_paths = []
-    for i, fp in enumerate(frame_paths):
-        img = Image.open(fp).convert("RGB")
-        depth_img = estimate_depth(processor, model, img, device)
-        out_path = output_dir / f"depth_{fp.stem}.png"
-        depth_img.save(out_path)
-        depth_paths.append(out_path)
-        if i % 30 == 0:
-            print(f"  Depth estimation: {i+1}/{len(frame_paths)}")
-    del model, processor
+    frames: np.ndarray,
+    indices: list[int],
+    out: np.ndarray,
+    batch_size: int = 1,
+    backend: str = "torch",
+) -> int:
+    """Estimate depth for the (N, H, W, 3) RGB `frames` at `indices`; slot k
+    of the (len(indices), H, W, 1) track `out` holds frame indices[k].
+
+    Frames are processed `batch_size` at a time with one forward pass per
+    batch; a background thread preprocesses the next batch meanwhile.
+    `backend` selects the torch or ONNX Runtime model (see load_depth_model).
+    Returns the number of frames processed."""
+    processor, model = load_depth_model(model_id, device, backend)
+    if backend == "onnx":
+        device = "cpu"
+        if indices:
+            sample = [frames[idx] for idx in indices[:2]]
+            model = _verified_backend(processor, model, model_id, sample)
+    size = frames.shape[1:3]
+    batch_size = max(1, batch_size)
+    batches = [indices[s:s + batch_size] for s in range(0, len(indices), batch_size)]
+
+    def _prepare(batch: list[int]):
+        return processor(images=[frames[idx] for idx in batch], return_tensors="pt")
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        pending = prefetch.submit(_prepare, batches[0]) if batches else None
+        for b, batch in enumerate(batches):
+            inputs = pending.result()
+            if b + 1 < len(batches):
+                pending = prefetch.submit(_prepare, batches[b + 1])
+            out[done:done + len(batch), :, :, 0] = _predict_depth(model, inputs, size, device)
+            done += len(batch)
+            if b % max(1, 30 // batch_size) == 0:
+                print(f"  Depth estimation: {done}/{len(indices)}")
+
+    out.flush()
+    del model
     torch.cuda.empty_cache()
-    return depth_paths
+    return done
@@ -1,39 +1,318 @@
+import os
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterable
 
+import numpy as np
 
-def encode_video(
-    frame_dir: Path,
-    output_path: Path,
-    fps: float,
-) -> Path:
-    """Encode PNG frames into an H.264 MP4 video."""
-    output_path.parent.mkdir(parents=True, exist_ok=True)
 
-    frames = sorted(frame_dir.glob("final_*.png"))
-    if not frames:
-        raise FileNotFoundError(f"No final_*.png frames found in {frame_dir}")
+def _x264_args(faststart: bool = True, threads: int = 0) -> list[str]:
+    """libx264 output options with the preset / CRF of the current tier."""
+    import config
+
+    args = [
+        "-c:v", "libx264",
+        "-preset", config.ENCODE_PRESET,
+        "-crf", str(config.ENCODE_CRF),
+        "-pix_fmt", "yuv420p",
+    ]
+    if threads:
+        # Segments: closed GOPs so they concatenate cleanly, CPU split between them
+        args += ["-flags", "+cgop", "-threads", str(threads)]
+    if faststart:
+        args += ["-movflags", "+faststart"]
+    return args
+
 
-    # Use ffmpeg concat demuxer for reliable frame ordering
-    filelist = frame_dir / "_filelist.txt"
-    with open(filelist, "w") as f:
-        for fp in frames:
-            f.write(f"file '{fp.name}'\n")
-            f.write(f"duration {1.0 / fps}\n")
+def segment_bounds(total: int, segments: int) -> list[tuple[int, int]]:
+    """Split `total` frames into (start, end) ranges for parallel encoding.
 
+    `segments` 0 means one per config.ENCODE_SEGMENT_CORES cores; ranges are
+    never shorter than config.ENCODE_MIN_SEGMENT_FRAMES."""
+    import config
+
+    if segments <= 0:
+        segments = max(1, (os.cpu_count() or 1) // max(1, config.ENCODE_SEGMENT_CORES))
+    segments = max(1, min(segments, total // max(1, config.ENCODE_MIN_SEGMENT_FRAMES)))
+    edges = np.linspace(0, total, segments + 1).round().astype(int)
+    return [(int(start), int(end)) for start, end in zip(edges, edges[1:])]
+
+
+def _segment_path(output_path: Path, k: int) -> Path:
+    return output_path.with_name(f"{output_path.stem}.part{k:03d}{output_path.suffix}")
+
+
+def _concat(segment_paths: list[Path], output_path: Path):
+    """Losslessly join closed-GOP segments (stream copy) into `output_path`."""
+    filelist = output_path.with_name(f"{output_path.stem}.parts.txt")
+    filelist.write_text("".join(f"file '{p.resolve()}'\n" for p in segment_paths))
     cmd = [
         "ffmpeg", "-y",
         "-f", "concat",
         "-safe", "0",
         "-i", str(filelist),
-        "-vf", f"fps={fps}",
-        "-c:v", "libx264",
-        "-preset", "medium",
-        "-crf", "18",
-        "-pix_fmt", "yuv420p",
+        "-c", "copy",
         "-movflags", "+faststart",
         str(output_path),
     ]
+    try:
+        subprocess.run(cmd, capture_output=True, check=True)
+    finally:
+        filelist.unlink(missing_ok=True)
+        for p in segment_paths:
+            p.unlink(missing_ok=True)
+
+
+class _RawVideoSink:
+    """ffmpeg process encoding rawvideo frames written to its stdin.
+
+    stderr is drained on a thread so a chatty ffmpeg never blocks on a full
+    pipe; it is attached to the CalledProcessError raised on failure.
+    `output_args` replaces the default MP4 output options (x264 + path).
+    """
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        output_path: Path,
+        fps: float,
+        pix_fmt: str = "rgb24",
+        faststart: bool = True,
+        threads: int = 0,
+        output_args: list[str] = None,
+    ):
+        self.shape = (height, width, 3)
+        self.output_path = output_path
+        if output_args is None:
+            output_args = [*_x264_args(faststart, threads), str(output_path)]
+        self.cmd = [
+            "ffmpeg", "-y", "-v", "error",
+            "-f", "rawvideo",
+            "-pix_fmt", pix_fmt,
+            "-s", f"{width}x{height}",
+            "-r", str(fps),
+            "-i", "pipe:0",
+            *output_args,
+        ]
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stderr_chunks = []
+        self._stderr_reader = threading.Thread(
+            target=lambda: self._stderr_chunks.append(self.proc.stderr.read()), daemon=True
+        )
+        self._stderr_reader.start()
+        self.count = 0
+
+    def _stderr(self) -> str:
+        self._stderr_reader.join()
+        return b"".join(self._stderr_chunks).decode(errors="replace")
+
+    def _failed(self) -> subprocess.CalledProcessError:
+        returncode = self.proc.wait()
+        return subprocess.CalledProcessError(returncode or 1, self.cmd, stderr=self._stderr())
+
+    def write(self, frame: np.ndarray):
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame {self.count} has shape {frame.shape}, expected {self.shape}")
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+        except BrokenPipeError:
+            # ffmpeg exited early; its stderr says why
+            raise self._failed() from None
+        self.count += 1
+
+    def close_input(self):
+        """Signal end of input; ffmpeg keeps encoding in the background."""
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def finish(self):
+        """Wait for ffmpeg and raise if it failed."""
+        self.close_input()
+        if self.proc.wait() != 0:
+            raise self._failed()
+        self._stderr()
+
+    def abort(self):
+        """Stop ffmpeg and remove the partial output."""
+        self.proc.kill()
+        self.proc.wait()
+        self._stderr()
+        self.output_path.unlink(missing_ok=True)
+
+
+def encode_frames(
+    frames: Iterable[np.ndarray],
+    width: int,
+    height: int,
+    output_path: Path,
+    fps: float,
+    pix_fmt: str = "rgb24",
+    total: int = None,
+) -> int:
+    """Encode a stream of (height, width, 3) uint8 frames into an H.264 MP4
+    by piping them to ffmpeg's stdin as rawvideo; nothing touches disk
+    besides the output.
+
+    `pix_fmt` is "rgb24" or "bgr24" (OpenCV order). If ffmpeg exits early
+    (broken pipe) or fails, CalledProcessError carries its stderr; if the
+    frame source raises, ffmpeg is stopped and the partial output removed.
+
+    A stream arrives in order, so it goes to a single encoder with all
+    threads; parallel time segments need the whole track (see encode_track).
+    Returns the number of frames written."""
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    sink = _RawVideoSink(width, height, output_path, fps, pix_fmt)
+    try:
+        for frame in frames:
+            sink.write(frame)
+            if total and sink.count % 30 == 1:
+                print(f"  Encode: {sink.count}/{total}")
+        if not sink.count:
+            raise ValueError(f"No frames to encode into {output_path}")
+        sink.finish()
+    except BaseException:
+        sink.abort()
+        raise
+    return sink.count
+
+
+def encode_progressive(
+    frames: Iterable[np.ndarray],
+    width: int,
+    height: int,
+    output_path: Path,
+    hls_dir: Path,
+    fps: float,
+    total: int = None,
+    on_playlist: Callable[[Path], None] = None,
+) -> int:
+    """Encode a frame stream as fragmented-MP4 HLS while it is produced,
+    then remux the segments (stream copy) into the final MP4.
+
+    ffmpeg writes `hls_dir/init.mp4`, `segment_*.m4s` of
+    config.HLS_SEGMENT_SECONDS each (every one starting on a keyframe) and
+    an EVENT playlist `hls_dir/playlist.m3u8` that grows with every segment,
+    so playback can start long before the job finishes. How early depends
+    on the caller: render_style streams the finished prefix while keyframes
+    are still being stylized, but only when refinement is off (refine
+    rewrites frames, so the stream waits for it). `on_playlist` is called
+    once with the playlist path as soon as it lists a segment.
+    Returns the number of frames written."""
+    import config
+
+    hls_dir.mkdir(parents=True, exist_ok=True)
+    for stale in hls_dir.glob("*"):
+        stale.unlink()
+    playlist = hls_dir / "playlist.m3u8"
+    seconds = config.HLS_SEGMENT_SECONDS
+    output_args = [
+        *_x264_args(faststart=False),
+        "-force_key_frames", f"expr:gte(t,n_forced*{seconds})",
+        "-f", "hls",
+        "-hls_time", str(seconds),
+        "-hls_playlist_type", "event",
+        "-hls_segment_type", "fmp4",
+        "-hls_fmp4_init_filename", "init.mp4",
+        "-hls_segment_filename", str(hls_dir / "segment_%05d.m4s"),
+        "-hls_flags", "independent_segments+temp_file",
+        str(playlist),
+    ]
+    sink = _RawVideoSink(width, height, playlist, fps, output_args=output_args)
+    announced = False
+
+    def _announce():
+        nonlocal announced
+        if on_playlist and not announced and playlist.exists() and "#EXTINF" in playlist.read_text():
+            announced = True
+            on_playlist(playlist)
+
+    try:
+        for frame in frames:
+            sink.write(frame)
+            if sink.count % 30 == 1:
+                if total:
+                    print(f"  Encode: {sink.count}/{total}")
+                _announce()
+        if not sink.count:
+            raise ValueError(f"No frames to encode into {playlist}")
+        sink.finish()
+    except BaseException:
+        sink.abort()
+        raise
+    _announce()
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", str(playlist),
+        "-c", "copy",
+        "-movflags", "+faststart",
+        str(output_path),
+    ]
+    subprocess.run(cmd, capture_output=True, check=True)
+    return sink.count
+
+
+def encode_track(
+    track_path: Path,
+    width: int,
+    height: int,
+    output_path: Path,
+    fps: float,
+    segments: int = 1,
+) -> Path:
+    """Encode a raw RGB frame track (see frame_store) into an H.264 MP4 video.
+    ffmpeg reads the track file directly, no per-frame images involved.
+
+    With `segments` != 1 (0 = auto, see segment_bounds), time segments of
+    the track are encoded concurrently by separate closed-GOP ffmpeg
+    processes and concatenated without re-encoding."""
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    frames = np.memmap(track_path, dtype=np.uint8, mode="r").reshape(-1, height, width, 3)
+    bounds = segment_bounds(len(frames), segments) if segments != 1 else [(0, len(frames))]
+    if len(bounds) > 1:
+        threads = max(1, (os.cpu_count() or 1) // len(bounds))
+        paths = [_segment_path(output_path, k) for k in range(len(bounds))]
+
+        def _encode_segment(k: int):
+            start, end = bounds[k]
+            sink = _RawVideoSink(width, height, paths[k], fps, faststart=False, threads=threads)
+            try:
+                for i in range(start, end):
+                    sink.write(frames[i])
+                sink.finish()
+            except BaseException:
+                sink.abort()
+                raise
+
+        print(f"  Encoding {len(bounds)} segments in parallel")
+        with ThreadPoolExecutor(len(bounds)) as pool:
+            futures = [pool.submit(_encode_segment, k) for k in range(len(bounds))]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for p in paths:
+                p.unlink(missing_ok=True)
+            raise
+        _concat(paths, output_path)
+        return output_path
+
+    cmd = [
+        "ffmpeg", "-y",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-s", f"{width}x{height}",
+        "-r", str(fps),
+        "-i", str(track_path),
+        *_x264_args(),
+        str(output_path),
+    ]
     subprocess.run(cmd, capture_output=True, check=True)
-    filelist.unlink(missing_ok=True)
     return output_path
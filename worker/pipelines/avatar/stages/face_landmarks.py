@@ -354,11 +354,35 @@ _FACE_CONNECTIONS = frozenset([
 ])
 
 
-def create_landmarker(model_path: Path) -> FaceLandmarker:
-    """Create MediaPipe FaceLandmarker instance."""
+# FaceLandmarker mesh size (468 face points + 10 iris points)
+_NUM_LANDMARKS = 478
+
+# Undirected, deduplicated (E, 2) edge list for vectorized drawing
+_MESH_EDGES = np.array(
+    sorted({tuple(sorted(edge)) for edge in _FACE_CONNECTIONS}), dtype=np.int32
+)
+
+# Key landmark points with colored dots (RGB)
+_KEY_POINTS = {
+    1: (0, 255, 0),      # nose tip
+    33: (0, 0, 255),     # left eye inner
+    263: (0, 0, 255),    # right eye inner
+    61: (255, 0, 0),     # left mouth corner
+    291: (255, 0, 0),    # right mouth corner
+    10: (0, 255, 255),   # forehead
+    152: (0, 255, 255),  # chin
+}
+
+
+def create_landmarker(model_path: Path, video: bool = False) -> FaceLandmarker:
+    """Create MediaPipe FaceLandmarker instance.
+
+    With `video=True` the landmarker runs in VIDEO mode: it tracks the face
+    from frame to frame and only re-runs face detection when tracking is lost.
+    Frames must then be fed in order via `detect_for_video`."""
     options = FaceLandmarkerOptions(
         base_options=BaseOptions(model_asset_path=str(model_path)),
-        running_mode=RunningMode.IMAGE,
+        running_mode=RunningMode.VIDEO if video else RunningMode.IMAGE,
         num_faces=1,
         output_face_blendshapes=False,
         output_facial_transformation_matrixes=False,
@@ -366,68 +390,103 @@ def create_landmarker(model_path: Path) -> FaceLandmarker:
     return FaceLandmarker.create_from_options(options)
 
 
-def detect_and_render(
+def detect_landmarks(
     landmarker: FaceLandmarker,
-    frame_path: Path,
-    output_path: Path,
+    frame: np.ndarray,
+    timestamp_ms: int = None,
+) -> np.ndarray:
+    """Detect face landmarks in an RGB frame.
+    Pass `timestamp_ms` when the landmarker runs in VIDEO mode.
+    Returns (478, 3) normalized (x, y, z) landmarks, or None if no face."""
+    mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=np.ascontiguousarray(frame))
+    if timestamp_ms is None:
+        result = landmarker.detect(mp_image)
+    else:
+        result = landmarker.detect_for_video(mp_image, timestamp_ms)
+
+    if not result.face_landmarks:
+        return None
+    return np.array(
+        [(lm.x, lm.y, lm.z) for lm in result.face_landmarks[0]], dtype=np.float32
+    )
+
+
+def render_pose(
+    landmarks: np.ndarray,
     width: int,
     height: int,
-) -> bool:
-    """Detect face landmarks and render openpose-style image.
-    Returns True if face was detected."""
-    mp_image = mp.Image.create_from_file(str(frame_path))
-    result = landmarker.detect(mp_image)
+    canvas: np.ndarray = None,
+) -> np.ndarray:
+    """Render an openpose-style RGB image of normalized landmarks at
+    width x height (into `canvas` if given). `landmarks` may be None for
+    frames without a face, which gives a black image."""
+    if canvas is None:
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+    else:
+        canvas[:] = 0
+    if landmarks is None:
+        return canvas
 
-    canvas = np.zeros((height, width, 3), dtype=np.uint8)
+    # (478, 2) pixel coordinates, truncated like int(x * width)
+    points = (
+        landmarks[:, :2].astype(np.float64) * np.array([width, height], dtype=np.float64)
+    ).astype(np.int32)
+
+    # Draw all face mesh connections in one call (one 2-point polyline per edge)
+    cv2.polylines(canvas, points[_MESH_EDGES], False, (255, 255, 255), 1)
+
+    for idx, color in _KEY_POINTS.items():
+        cv2.circle(canvas, tuple(int(v) for v in points[idx]), 3, color, -1)
+
+    return canvas
 
-    if not result.face_landmarks:
-        cv2.imwrite(str(output_path), canvas)
-        return False
 
-    landmarks = result.face_landmarks[0]
-    # Draw face mesh connections
-    for connection in _FACE_CONNECTIONS:
-        start = landmarks[connection[0]]
-        end = landmarks[connection[1]]
-        pt1 = (int(start.x * width), int(start.y * height))
-        pt2 = (int(end.x * width), int(end.y * height))
-        cv2.line(canvas, pt1, pt2, (255, 255, 255), 1)
+def save_landmarks(
+    path: Path, landmarks: np.ndarray, detected: np.ndarray, indices: list[int]
+):
+    """Save per-frame landmarks as one compressed .npz: float16 (K, 478, 3)
+    landmarks, a bool (K,) detected mask and the (K,) frame indices."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.stem + ".tmp.npz")
+    np.savez_compressed(
+        tmp_path,
+        landmarks=landmarks.astype(np.float16),
+        detected=detected.astype(bool),
+        indices=np.asarray(indices, dtype=np.int32),
+    )
+    tmp_path.replace(path)
 
-    # Key landmark points with colored dots
-    KEY_POINTS = {
-        1: (0, 255, 0),      # nose tip
-        33: (255, 0, 0),     # left eye inner
-        263: (255, 0, 0),    # right eye inner
-        61: (0, 0, 255),     # left mouth corner
-        291: (0, 0, 255),    # right mouth corner
-        10: (255, 255, 0),   # forehead
-        152: (255, 255, 0),  # chin
-    }
-    for idx, color in KEY_POINTS.items():
-        lm = landmarks[idx]
-        pt = (int(lm.x * width), int(lm.y * height))
-        cv2.circle(canvas, pt, 3, color, -1)
 
-    cv2.imwrite(str(output_path), canvas)
-    return True
+def load_landmarks(path: Path) -> tuple[np.ndarray, np.ndarray, list[int]]:
+    """Load (landmarks, detected, indices) written by save_landmarks."""
+    with np.load(path) as data:
+        return data["landmarks"], data["detected"], data["indices"].tolist()
 
 
 def process_frames(
     model_path: Path,
-    frame_paths: list[Path],
-    output_dir: Path,
-    width: int,
-    height: int,
-) -> list[Path]:
-    """Process all frames, return paths to openpose-style renders."""
-    output_dir.mkdir(parents=True, exist_ok=True)
-    landmarker = create_landmarker(model_path)
-    pose_paths = []
-    for i, fp in enumerate(frame_paths):
-        out_path = output_dir / f"pose_{fp.stem}.png"
-        detect_and_render(landmarker, fp, out_path, width, height)
-        pose_paths.append(out_path)
-        if i % 30 == 0:
-            print(f"  Face landmarks: {i+1}/{len(frame_paths)}")
+    frames: np.ndarray,
+    indices: list[int],
+    output_path: Path,
+    fps: float = None,
+) -> int:
+    """Detect landmarks for the (N, H, W, 3) RGB `frames` at `indices` and
+    save them to `output_path` (see save_landmarks).
+
+    If `fps` is given, landmarks are tracked in VIDEO mode with timestamps
+    derived from the frame index (`indices` must be increasing).
+    Returns the number of frames with a detected face."""
+    landmarker = create_landmarker(model_path, video=fps is not None)
+    landmarks = np.zeros((len(indices), _NUM_LANDMARKS, 3), dtype=np.float32)
+    detected = np.zeros(len(indices), dtype=bool)
+    for k, idx in enumerate(indices):
+        timestamp_ms = int(round(idx * 1000.0 / fps)) if fps else None
+        lms = detect_landmarks(landmarker, frames[idx], timestamp_ms)
+        if lms is not None:
+            landmarks[k] = lms[:_NUM_LANDMARKS]
+            detected[k] = True
+        if k % 30 == 0:
+            print(f"  Face landmarks: {k+1}/{len(indices)}")
     landmarker.close()
-    return pose_paths
+    save_landmarks(output_path, landmarks, detected, indices)
+    return int(detected.sum())
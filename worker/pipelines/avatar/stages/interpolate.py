@@ -1,110 +1,379 @@
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
 import cv2
 import numpy as np
-from PIL import Image
-from pathlib import Path
+
+from pipelines.avatar import flow
+
+
+@functools.lru_cache(maxsize=8)
+def _base_grid(width: int, height: int) -> np.ndarray:
+    """(H, W, 2) float32 pixel coordinates, built once per resolution."""
+    grid = np.dstack(np.meshgrid(
+        np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32)
+    ))
+    grid.setflags(write=False)
+    return grid
 
 
 def interpolate_opencv_dis(
-    frame_before: Image.Image,
-    frame_after: Image.Image,
+    arr_before: np.ndarray,
+    arr_after: np.ndarray,
     num_intermediate: int,
-) -> list[Image.Image]:
+) -> list[np.ndarray]:
     """Interpolate frames using OpenCV DIS optical flow.
 
     Args:
-        frame_before: First keyframe
-        frame_after: Second keyframe
+        arr_before: First keyframe (H, W, 3) RGB
+        arr_after: Second keyframe (H, W, 3) RGB
         num_intermediate: Number of frames to generate between keyframes
 
     Returns:
-        List of interpolated PIL Images (not including keyframes themselves)
+        List of interpolated RGB arrays (not including keyframes themselves)
     """
-    # Convert to numpy arrays
-    arr_before = np.array(frame_before)
-    arr_after = np.array(frame_after)
-
-    # Create DIS optical flow estimator
-    dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
     gray_before = cv2.cvtColor(arr_before, cv2.COLOR_RGB2GRAY)
     gray_after = cv2.cvtColor(arr_after, cv2.COLOR_RGB2GRAY)
 
-    # Compute optical flow from before → after
-    flow = dis.calc(gray_before, gray_after, None)
+    # Compute optical flow from before → after (this thread's DIS instance)
+    flow_field = flow.calc(gray_before, gray_after)
 
     # Generate intermediate frames by warping
     interpolated = []
     h, w = arr_before.shape[:2]
+    grid = _base_grid(w, h)
 
     for i in range(1, num_intermediate + 1):
         t = i / (num_intermediate + 1)  # Interpolation weight (0 < t < 1)
 
         # Create flow map for warping
-        # Scale flow by interpolation weight
-        flow_map = flow * t
-        # Add pixel coordinates
-        flow_map[:, :, 0] += np.arange(w)
-        flow_map[:, :, 1] += np.arange(h)[:, np.newaxis]
+        # Scale flow by interpolation weight, add pixel coordinates
+        flow_map = flow_field * t
+        flow_map += grid
 
         # Warp the before frame using flow
         warped = cv2.remap(arr_before, flow_map, None, cv2.INTER_LINEAR)
 
         # Blend warped frame with after frame for smoother results
         blended = cv2.addWeighted(warped, 1 - t, arr_after, t, 0)
-        interpolated.append(Image.fromarray(blended))
+        interpolated.append(blended)
 
     return interpolated
 
 
+def interpolate_bidirectional(
+    arr_before: np.ndarray,
+    arr_after: np.ndarray,
+    flow_fwd: np.ndarray,
+    flow_bwd: np.ndarray,
+    num_intermediate: int,
+) -> list[np.ndarray]:
+    """Interpolate frames by warping both keyframes towards each time step.
+
+    Args:
+        arr_before: First keyframe (H, W, 3) RGB
+        arr_after: Second keyframe (H, W, 3) RGB
+        flow_fwd: Flow before -> after (any resolution, see flow.gap_flows)
+        flow_bwd: Flow after -> before
+        num_intermediate: Number of frames to generate between keyframes
+
+    Returns:
+        List of interpolated RGB arrays (not including keyframes themselves)
+    """
+    h, w = arr_before.shape[:2]
+    fwd = flow.resize_flow(flow_fwd, (w, h))
+    bwd = flow.resize_flow(flow_bwd, (w, h))
+    grid = _base_grid(w, h)
+
+    interpolated = []
+    for i in range(1, num_intermediate + 1):
+        t = i / (num_intermediate + 1)
+        # Sampling maps from time t back to each keyframe, with the flows
+        # approximated from the keyframe-to-keyframe flows (linear motion)
+        map_t0 = cv2.addWeighted(fwd, -(1 - t) * t, bwd, t * t, 0)
+        map_t0 += grid
+        map_t1 = cv2.addWeighted(fwd, (1 - t) * (1 - t), bwd, -t * (1 - t), 0)
+        map_t1 += grid
+        warped_before = cv2.remap(arr_before, map_t0, None, cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_REPLICATE)
+        warped_after = cv2.remap(arr_after, map_t1, None, cv2.INTER_LINEAR,
+                                 borderMode=cv2.BORDER_REPLICATE)
+        interpolated.append(cv2.addWeighted(warped_before, 1 - t, warped_after, t, 0))
+    return interpolated
+
+
+def warp_previous(
+    prev_frame: np.ndarray,
+    prev_source: np.ndarray,
+    source: np.ndarray,
+    max_side: int = 512,
+) -> np.ndarray:
+    """Warp `prev_frame` (aligned with `prev_source`) onto the pixel grid of
+    `source`, using DIS optical flow between the two source frames.
+
+    Flow is computed on grayscale sources downscaled to at most `max_side`
+    pixels and scaled back up. All inputs are RGB; the result has the size
+    of `source`.
+    """
+    h, w = source.shape[:2]
+    if prev_frame.shape[:2] != (h, w):
+        prev_frame = cv2.resize(prev_frame, (w, h), interpolation=cv2.INTER_AREA)
+    if prev_source.shape[:2] != (h, w):
+        prev_source = cv2.resize(prev_source, (w, h), interpolation=cv2.INTER_AREA)
+
+    small = flow.flow_size(w, h, max_side)
+    # Backward flow: where each pixel of the current frame was in the previous one
+    back = flow.calc(flow.to_gray(source, small), flow.to_gray(prev_source, small))
+    back = flow.resize_flow(back, (w, h))
+
+    back += _base_grid(w, h)
+    return cv2.remap(prev_frame, back, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def _interpolate_gap(
+    arr_before: np.ndarray,
+    arr_after: np.ndarray,
+    before: int,
+    after: int,
+    source: np.ndarray,
+    flow_dir: Path,
+) -> np.ndarray:
+    """(after - before - 1, H, W, 3) frames between two keyframes."""
+    import config
+
+    num_intermediate = after - before - 1
+    if config.INTERPOLATION_METHOD == "opencv_dis":
+        interpolated = interpolate_opencv_dis(arr_before, arr_after, num_intermediate)
+    else:
+        fwd, bwd = flow.gap_flows(source, before, after, flow_dir, config.FLOW_MAX_SIDE)
+        interpolated = interpolate_bidirectional(arr_before, arr_after, fwd, bwd, num_intermediate)
+    return np.stack(interpolated)
+
+
+def _fill_gaps(
+    frames: np.ndarray,
+    gaps: Iterable[tuple[int, int]],
+    source: np.ndarray,
+    flow_dir: Path,
+    on_written: Callable[[int, int], None] = None,
+) -> int:
+    """Interpolate the frames strictly between each (before, after) keyframe
+    pair in place. `gaps` may be a stream (see ready_gaps); `on_written` is
+    called from the writer with the (start, end) range of each written gap.
+
+    Gaps are interpolated on a thread pool (OpenCV releases the GIL) and
+    written back by a single background writer. Only the keyframe pairs and
+    results of the gaps in flight (2 per worker) are held in memory.
+    Returns the number of frames written."""
+    import config
+
+    workers = max(1, config.INTERPOLATE_WORKERS)
+    written = 0
+
+    def _write(before: int, after: int, interpolated: np.ndarray):
+        frames[before + 1:after] = interpolated
+        if on_written:
+            on_written(before + 1, after)
+
+    with ThreadPoolExecutor(workers) as pool, ThreadPoolExecutor(1) as writer:
+        pending = deque()
+        last_write = None
+
+        def _drain_one():
+            nonlocal last_write, written
+            before, after, future = pending.popleft()
+            interpolated = future.result()
+            if last_write is not None:
+                last_write.result()  # One write in flight bounds memory
+            last_write = writer.submit(_write, before, after, interpolated)
+            written += after - before - 1
+
+        for before, after in gaps:
+            if after - before < 2:
+                continue
+            # Keyframe slots are never written here, so copies are consistent
+            future = pool.submit(
+                _interpolate_gap,
+                np.array(frames[before]), np.array(frames[after]),
+                before, after, source, flow_dir,
+            )
+            pending.append((before, after, future))
+            if len(pending) >= 2 * workers:
+                _drain_one()
+        while pending:
+            _drain_one()
+        if last_write is not None:
+            last_write.result()
+    return written
+
+
+def ready_gaps(keyframe_indices: list[int], completed: Iterable[int]) -> Iterator[tuple[int, int]]:
+    """Yield each (before, after) keyframe gap as soon as both of its
+    keyframes have appeared in the `completed` stream."""
+    position = {idx: k for k, idx in enumerate(keyframe_indices)}
+    done = set()
+    for idx in completed:
+        done.add(idx)
+        k = position[idx]
+        if k > 0 and keyframe_indices[k - 1] in done:
+            yield keyframe_indices[k - 1], idx
+        if k + 1 < len(keyframe_indices) and keyframe_indices[k + 1] in done:
+            yield idx, keyframe_indices[k + 1]
+
+
 def process_keyframes(
-    keyframe_paths: list[Path],
-    all_frame_indices: list[int],
-    keyframe_interval: int,
-    output_dir: Path,
-) -> list[Path]:
-    """Expand keyframes to full frame sequence via optical flow interpolation.
+    frames: np.ndarray,
+    keyframe_indices: list[int],
+    source: np.ndarray,
+    flow_dir: Path = None,
+    completed: Iterable[int] = None,
+    on_ready: Callable[[int], None] = None,
+) -> int:
+    """Fill a full-length styled track from its keyframes via optical flow.
 
     Args:
-        keyframe_paths: Paths to stylized keyframes
-        all_frame_indices: Complete list of frame indices (e.g., [0, 1, 2, ..., 299])
-        keyframe_interval: Spacing between keyframes (e.g., 5 for 1-in-5)
-        output_dir: Directory to save full sequence
+        frames: (N, H, W, 3) styled track; slots in keyframe_indices hold keyframes
+        keyframe_indices: Sorted keyframe positions, uniform (0, k, 2k, ...)
+            or not (see keyframes.select_keyframes)
+        source: (N, H, W, 3) source track the flow is computed on
+            (config.INTERPOLATION_METHOD "source_flow")
+        flow_dir: Flow field cache directory (None = no caching)
+        completed: Stream of keyframe indices as they are stylized, to
+            interpolate concurrently with stylization (None = all are done)
+        on_ready: Called with a growing n whenever frames [0, n) are final,
+            so later stages can consume the track while it is filled
 
     Returns:
-        List of paths to all frames (keyframes + interpolated)
+        Number of frames written (interpolated + head/tail)
     """
-    output_dir.mkdir(parents=True, exist_ok=True)
+    num_frames = len(frames)
 
-    # Load all keyframes
-    keyframes = [Image.open(p).convert("RGB") for p in keyframe_paths]
-    all_paths = []
+    # Contiguous prefix of final frames (keyframes + written gaps)
+    final = np.zeros(num_frames, dtype=bool)
+    ready = 0
+    lock = threading.Lock()
+
+    def _mark(start: int, end: int):
+        nonlocal ready
+        if on_ready is None:
+            return
+        # Reported under the lock, so calls arrive in increasing order
+        with lock:
+            final[start:end] = True
+            previous = ready
+            while ready < num_frames and final[ready]:
+                ready += 1
+            if ready > previous:
+                on_ready(ready)
+
+    def _tracked(indices: Iterable[int]) -> Iterator[int]:
+        for idx in indices:
+            _mark(idx, idx + 1)
+            yield idx
 
     # Process pairs of keyframes
-    for i in range(len(keyframes) - 1):
-        # Save current keyframe
-        keyframe_idx = i * keyframe_interval
-        out_path = output_dir / f"frame_{keyframe_idx:05d}.png"
-        keyframes[i].save(out_path)
-        all_paths.append(out_path)
-
-        # Interpolate intermediate frames
-        num_intermediate = keyframe_interval - 1
-        if num_intermediate > 0:
-            interpolated = interpolate_opencv_dis(
-                keyframes[i], keyframes[i + 1], num_intermediate
-            )
-            for j, img in enumerate(interpolated):
-                idx = keyframe_idx + j + 1
-                out_path = output_dir / f"frame_{idx:05d}.png"
-                img.save(out_path)
-                all_paths.append(out_path)
-
-    # Save final keyframe
-    final_keyframe_idx = (len(keyframes) - 1) * keyframe_interval
-    out_path = output_dir / f"frame_{final_keyframe_idx:05d}.png"
-    keyframes[-1].save(out_path)
-    all_paths.append(out_path)
-
-    print(
-        f"  Interpolated {len(all_paths)} frames from {len(keyframes)} keyframes (1:{keyframe_interval})"
-    )
-    return all_paths
+    if completed is None:
+        for idx in keyframe_indices:
+            _mark(idx, idx + 1)
+        gaps = zip(keyframe_indices, keyframe_indices[1:])
+    else:
+        gaps = ready_gaps(keyframe_indices, _tracked(completed))
+    written = _fill_gaps(frames, gaps, source, flow_dir, on_written=_mark)
+
+    # Frames outside the first/last keyframe have no partner: hold that keyframe
+    first, last = keyframe_indices[0], keyframe_indices[-1]
+    if first > 0:
+        frames[:first] = frames[first]
+        written += first
+    if last < num_frames - 1:
+        frames[last + 1:] = frames[last]
+        written += num_frames - 1 - last
+
+    frames.flush()
+    _mark(0, num_frames)
+    print(f"  Interpolated {num_frames} frames from {len(keyframe_indices)} keyframes")
+    return written
+
+
+def interpolation_errors(
+    source: np.ndarray,
+    keyframe_indices: list[int],
+    flow_dir: Path = None,
+) -> np.ndarray:
+    """Estimate how badly flow interpolation does on each frame.
+
+    Every gap is interpolated on the (downscaled) source frames themselves
+    and compared with the real source frames: where the flow model cannot
+    explain the source motion (occlusions, fast turns), the styled
+    interpolation fails the same way. Uses (and fills) the flow cache in
+    `flow_dir`, at the flow resolution.
+
+    Returns:
+        (N,) float32 mean absolute error (0-255); 0 for keyframes and for
+        frames outside the first/last keyframe.
+    """
+    import config
+
+    height, width = source.shape[1:3]
+    small = flow.flow_size(width, height, config.FLOW_MAX_SIDE)
+
+    errors = np.zeros(len(source), dtype=np.float32)
+    for before, after in zip(keyframe_indices, keyframe_indices[1:]):
+        num_intermediate = after - before - 1
+        if num_intermediate <= 0:
+            continue
+        fwd, bwd = flow.gap_flows(source, before, after, flow_dir, config.FLOW_MAX_SIDE)
+        predicted = interpolate_bidirectional(
+            flow.thumbnail(source[before], small),
+            flow.thumbnail(source[after], small),
+            fwd, bwd, num_intermediate,
+        )
+        for idx, pred in zip(range(before + 1, after), predicted):
+            diff = cv2.absdiff(pred, flow.thumbnail(source[idx], small))
+            errors[idx] = diff.mean()
+    return errors
+
+
+def select_refinements(
+    errors: np.ndarray,
+    keyframe_indices: list[int],
+    threshold: float,
+    max_keyframes: int,
+) -> list[int]:
+    """Frames to stylize as extra keyframes: in each gap whose worst frame
+    exceeds `threshold`, that worst frame, for at most `max_keyframes`
+    gaps (worst first). Returns sorted frame indices."""
+    candidates = []
+    for before, after in zip(keyframe_indices, keyframe_indices[1:]):
+        if after - before < 2:
+            continue
+        worst = before + 1 + int(np.argmax(errors[before + 1:after]))
+        if errors[worst] > threshold:
+            candidates.append((float(errors[worst]), worst))
+    candidates.sort(reverse=True)
+    return sorted(idx for _, idx in candidates[:max_keyframes])
+
+
+def refill_gaps(
+    frames: np.ndarray,
+    keyframe_indices: list[int],
+    new_keyframes: list[int],
+    source: np.ndarray,
+    flow_dir: Path = None,
+) -> int:
+    """Re-interpolate only the gaps next to `new_keyframes`, which must
+    already be stylized into `frames` and included in `keyframe_indices`.
+    Returns the number of frames rewritten."""
+    new = set(new_keyframes)
+    gaps = [
+        (before, after)
+        for before, after in zip(keyframe_indices, keyframe_indices[1:])
+        if before in new or after in new
+    ]
+    written = _fill_gaps(frames, gaps, source, flow_dir)
+    frames.flush()
+    return written
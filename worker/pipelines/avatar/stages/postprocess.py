@@ -1,83 +1,146 @@
+from typing import Iterable, Iterator
+
 import cv2
 import numpy as np
-from pathlib import Path
+
+
+def lab_stats(frame: np.ndarray) -> np.ndarray:
+    """(2, 3) per-channel LAB mean and std of an RGB frame, in one pass."""
+    mean, std = cv2.meanStdDev(cv2.cvtColor(frame, cv2.COLOR_RGB2LAB))
+    return np.stack([mean[:, 0], std[:, 0]]).astype(np.float32)
+
+
+def reference_stats(originals: np.ndarray) -> np.ndarray:
+    """(N, 2, 3) LAB statistics of every original frame (see lab_stats),
+    computed once and reused by every style's color transfer."""
+    return np.stack([lab_stats(np.asarray(frame)) for frame in originals])
 
 
 def color_transfer(
-    source: np.ndarray, target: np.ndarray, strength: float
+    source: np.ndarray,
+    target: np.ndarray,
+    strength: float,
+    target_stats: np.ndarray = None,
 ) -> np.ndarray:
     """Transfer color statistics from target (original) to source (styled).
-    Uses LAB color space mean/std transfer, blended by strength."""
+    Both are RGB. Uses LAB color space mean/std transfer, blended by strength.
+
+    The transfer and the strength blend fold into one per-channel gain and
+    offset, applied in a single cv2.transform pass. `target_stats` (from
+    lab_stats) skips recomputing the target's statistics."""
     if strength <= 0:
         return source
 
-    src_lab = cv2.cvtColor(source, cv2.COLOR_BGR2LAB).astype(np.float32)
-    tgt_lab = cv2.cvtColor(target, cv2.COLOR_BGR2LAB).astype(np.float32)
+    src_lab = cv2.cvtColor(source, cv2.COLOR_RGB2LAB)
+    src_mean, src_std = cv2.meanStdDev(src_lab)
+    if target_stats is None:
+        target_stats = lab_stats(target)
+    tgt_mean, tgt_std = target_stats
 
-    for ch in range(3):
-        src_mean = src_lab[:, :, ch].mean()
-        src_std = src_lab[:, :, ch].std() + 1e-6
-        tgt_mean = tgt_lab[:, :, ch].mean()
-        tgt_std = tgt_lab[:, :, ch].std() + 1e-6
-        transferred = (src_lab[:, :, ch] - src_mean) * (tgt_std / src_std) + tgt_mean
-        src_lab[:, :, ch] = (
-            src_lab[:, :, ch] * (1 - strength) + transferred * strength
-        )
+    # (1 - s) * x + s * ((x - src_mean) * ratio + tgt_mean) = gain * x + offset
+    ratio = (tgt_std + 1e-6) / (src_std[:, 0] + 1e-6)
+    gain = (1 - strength) + strength * ratio
+    offset = strength * (tgt_mean - src_mean[:, 0] * ratio)
+    affine = np.zeros((3, 4), dtype=np.float32)
+    affine[np.arange(3), np.arange(3)] = gain
+    # -0.5: cv2 rounds on the uint8 cast; truncate like the float path did
+    affine[:, 3] = offset - 0.5
 
-    src_lab = np.clip(src_lab, 0, 255).astype(np.uint8)
-    return cv2.cvtColor(src_lab, cv2.COLOR_LAB2BGR)
+    return cv2.cvtColor(cv2.transform(src_lab, affine), cv2.COLOR_LAB2RGB)
 
 
-def temporal_blend(
-    frames: list[np.ndarray], index: int, radius: int
-) -> np.ndarray:
-    """Blend frame[index] with neighbors within radius for temporal smoothing."""
-    if radius <= 0:
-        return frames[index]
-
-    start = max(0, index - radius)
-    end = min(len(frames), index + radius + 1)
-    weights = []
-    stack = []
-    for i in range(start, end):
-        dist = abs(i - index)
-        w = 1.0 / (1.0 + dist)
-        weights.append(w)
-        stack.append(frames[i].astype(np.float32))
-
-    total_w = sum(weights)
-    blended = sum(f * (w / total_w) for f, w in zip(stack, weights))
-    return np.clip(blended, 0, 255).astype(np.uint8)
+def iter_frames(
+    styled: np.ndarray,
+    originals: np.ndarray,
+    color_match_strength: float,
+    temporal_blend_frames: int,
+    original_stats: np.ndarray = None,
+    ready: Iterable[int] = None,
+) -> Iterator[np.ndarray]:
+    """Color-match and temporally smooth styled frames, one at a time.
+
+    Each output frame is the weighted mean (weight 1 / (1 + distance)) of the
+    color-matched frames within `temporal_blend_frames` of it. Matched frames
+    are kept in a ring buffer of 2 * radius + 1 float32 slots and summed
+    into one preallocated accumulator, so peak memory does not depend on
+    the clip length.
+
+    Args:
+        styled: (N, H, W, 3) RGB styled track
+        originals: (N, h, w, 3) RGB source track (only its color statistics are used)
+        color_match_strength: See color_transfer
+        temporal_blend_frames: Smoothing radius in frames (0 = none)
+        original_stats: Precomputed reference_stats(originals), if available
+        ready: Stream of growing n such that styled frames [0, n) are final,
+            while an earlier stage still fills the track (None = all are).
+            Output frame i waits for frame i + temporal_blend_frames.
+
+    Yields:
+        (H, W, 3) uint8 RGB frames, in order
+    """
+    num_frames = len(styled)
+    radius = max(0, temporal_blend_frames)
+    available = num_frames if ready is None else 0
+    ready_iter = iter(ready) if ready is not None else None
+
+    def _matched(i: int) -> np.ndarray:
+        nonlocal available
+        while available <= i:
+            n = next(ready_iter, None)
+            if n is None:
+                raise ValueError(f"Styled track ended before frame {i} was ready")
+            available = n
+        stats = original_stats[i] if original_stats is not None else None
+        return color_transfer(np.asarray(styled[i]), originals[i], color_match_strength, stats)
+
+    if radius == 0:
+        for i in range(num_frames):
+            yield _matched(i)
+        return
+
+    size = 2 * radius + 1
+    ring = np.empty((size, *styled.shape[1:]), dtype=np.float32)
+    acc = np.empty(styled.shape[1:], dtype=np.float32)
+    loaded = 0  # Frames [0, loaded) have been matched into the ring
+
+    for i in range(num_frames):
+        while loaded < min(num_frames, i + radius + 1):
+            np.copyto(ring[loaded % size], _matched(loaded))
+            loaded += 1
+
+        start, end = max(0, i - radius), min(num_frames, i + radius + 1)
+        weights = [1.0 / (1.0 + abs(j - i)) for j in range(start, end)]
+        total_w = sum(weights)
+        acc.fill(0)
+        for j, w in zip(range(start, end), weights):
+            cv2.scaleAdd(ring[j % size], w / total_w, acc, dst=acc)
+        np.clip(acc, 0, 255, out=acc)
+        yield acc.astype(np.uint8)
 
 
 def process_frames(
-    styled_paths: list[Path],
-    original_paths: list[Path],
-    output_dir: Path,
+    styled: np.ndarray,
+    originals: np.ndarray,
+    out: np.ndarray,
     color_match_strength: float,
     temporal_blend_frames: int,
-) -> list[Path]:
-    """Apply color matching and temporal smoothing to styled frames."""
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    styled_bgr = [cv2.imread(str(p)) for p in styled_paths]
-    original_bgr = [cv2.imread(str(p)) for p in original_paths]
-
-    # Color transfer from originals
-    for i in range(len(styled_bgr)):
-        styled_bgr[i] = color_transfer(
-            styled_bgr[i], original_bgr[i], color_match_strength
-        )
-
-    # Temporal smoothing
-    result_paths = []
-    for i in range(len(styled_bgr)):
-        blended = temporal_blend(styled_bgr, i, temporal_blend_frames)
-        out_path = output_dir / f"final_{styled_paths[i].stem}.png"
-        cv2.imwrite(str(out_path), blended)
-        result_paths.append(out_path)
+    original_stats: np.ndarray = None,
+) -> int:
+    """Apply color matching and temporal smoothing to styled frames.
+
+    `styled`, `originals` and `out` are (N, H, W, 3) RGB tracks; `out` has
+    the shape of `styled`. Frames are streamed through `iter_frames`;
+    `original_stats` are the originals' precomputed reference_stats.
+    Returns the number of frames written."""
+    num_frames = len(styled)
+    frames = iter_frames(
+        styled, originals, color_match_strength, temporal_blend_frames, original_stats
+    )
+    for i, frame in enumerate(frames):
+        out[i] = frame
 
         if i % 30 == 0:
-            print(f"  Postprocess: {i+1}/{len(styled_bgr)}")
+            print(f"  Postprocess: {i+1}/{num_frames}")
 
-    return result_paths
+    out.flush()
+    return num_frames
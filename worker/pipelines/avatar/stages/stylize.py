@@ -1,119 +1,222 @@
+import weakref
+from collections import OrderedDict
+from typing import Callable
+
+import cv2
 import torch
+import numpy as np
 from PIL import Image
-from pathlib import Path
-from diffusers import (
-    StableDiffusionControlNetImg2ImgPipeline,
-    ControlNetModel,
-    UniPCMultistepScheduler,
-)
 
+from pipelines.avatar import face_roi, model_registry, result_cache
 from pipelines.avatar.style_config import StyleConfig
+from pipelines.avatar.stages import face_landmarks, interpolate
 
+# Style fields the diffusion call depends on (steps and LCM are keyed
+# separately; the warm start blend is part of the init image). Postprocess
+# settings are left out so tuning them keeps cached results valid.
+_DIFFUSION_FIELDS = (
+    "model_id",
+    "prompt_template",
+    "negative_prompt",
+    "denoising_strength",
+    "guidance_scale",
+    "controlnet_openpose_weight",
+    "controlnet_depth_weight",
+)
 
 def load_pipeline(style: StyleConfig, device: str, dtype_str: str):
-    """Load SD1.5 + dual ControlNet pipeline for the given style."""
+    """Get the SD1.5 + dual ControlNet pipeline for the given style from the
+    in-process model registry (loaded on first use, then reused)."""
     import config
 
-    dtype = torch.float16 if dtype_str == "float16" else torch.float32
-
-    controlnet_openpose = ControlNetModel.from_pretrained(
-        "lllyasviel/control_v11p_sd15_openpose",
-        torch_dtype=dtype,
-    )
-    controlnet_depth = ControlNetModel.from_pretrained(
-        "lllyasviel/control_v11f1p_sd15_depth",
-        torch_dtype=dtype,
-    )
-
-    pipe = StableDiffusionControlNetImg2ImgPipeline.from_pretrained(
-        style.model_id,
-        controlnet=[controlnet_openpose, controlnet_depth],
-        torch_dtype=dtype,
-        safety_checker=None,
-    )
-
     # Load LCM-LoRA if enabled globally and in style config
-    if config.USE_LCM_LORA and style.lcm_enabled:
-        from diffusers import LCMScheduler
-        pipe.load_lora_weights(config.LCM_LORA_ID)
-        pipe.scheduler = LCMScheduler.from_config(pipe.scheduler.config)
-        print(f"  Loaded LCM-LoRA ({config.LCM_LORA_ID}), using {style.lcm_steps} steps")
+    lcm = config.USE_LCM_LORA and style.lcm_enabled
+    pipe = model_registry.get_pipeline(style.model_id, dtype_str, device, lcm)
+    if lcm:
+        print(f"  LCM-LoRA ({config.LCM_LORA_ID}), using {style.lcm_steps} steps")
     else:
-        pipe.scheduler = UniPCMultistepScheduler.from_config(pipe.scheduler.config)
         print(f"  Standard inference, using {style.num_inference_steps} steps")
+    return pipe
 
-    pipe.to(device)
-    pipe.enable_attention_slicing()
 
-    return pipe
+# (text encoder id, prompt, negative prompt, cfg) -> (encoder weakref, embeds, negative embeds)
+_prompt_embeds: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+
+def encode_prompt(
+    pipe, style: StyleConfig, face_description: str = "person face"
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Prompt and negative prompt embeddings for a style, computed once and
+    kept in a small LRU (config.PROMPT_EMBED_CACHE_SIZE) so the text encoder
+    does not run for every frame. Returns (prompt_embeds, negative_embeds),
+    each with batch size 1; negative_embeds is None without CFG."""
+    import config
+
+    prompt = style.prompt_template.replace("{face_description}", face_description)
+    do_cfg = style.guidance_scale > 1.0
+    key = (id(pipe.text_encoder), prompt, style.negative_prompt, do_cfg)
+
+    cached = _prompt_embeds.get(key)
+    # The weakref guards against a reused id() after the registry evicted an encoder
+    if cached is not None and cached[0]() is pipe.text_encoder:
+        _prompt_embeds.move_to_end(key)
+        return cached[1], cached[2]
+
+    with torch.no_grad():
+        prompt_embeds, negative_embeds = pipe.encode_prompt(
+            prompt,
+            pipe.device,
+            1,
+            do_cfg,
+            negative_prompt=style.negative_prompt,
+        )
+    _prompt_embeds[key] = (weakref.ref(pipe.text_encoder), prompt_embeds, negative_embeds)
+    while len(_prompt_embeds) > max(1, config.PROMPT_EMBED_CACHE_SIZE):
+        _prompt_embeds.popitem(last=False)
+    return prompt_embeds, negative_embeds
+
+
+def inference_steps(style: StyleConfig) -> int:
+    """Scheduler steps: LCM steps if enabled, otherwise num_inference_steps."""
+    import config
+
+    return style.lcm_steps if (config.USE_LCM_LORA and style.lcm_enabled) else style.num_inference_steps
+
+
+def denoising_steps(style: StyleConfig, strength: float) -> int:
+    """Denoising steps img2img actually runs at `strength` (as in diffusers)."""
+    steps = inference_steps(style)
+    return min(int(steps * strength), steps)
+
 
+def warm_start_strength(style: StyleConfig) -> float:
+    """Reduced denoising strength for warm-started keyframes (>= 1 step)."""
+    steps = inference_steps(style)
+    return max(style.denoising_strength * style.warm_start_strength_scale, 1.0 / steps)
 
-def stylize_frame(
+
+def stylize_batch(
     pipe,
     style: StyleConfig,
-    source_image: Image.Image,
-    openpose_image: Image.Image,
-    depth_image: Image.Image,
+    source_images: list[Image.Image],
+    openpose_images: list[Image.Image],
+    depth_images: list[Image.Image],
     seed: int = 42,
     target_resolution: tuple = None,
-) -> Image.Image:
-    """Apply style to a single frame using img2img + ControlNet."""
+    face_description: str = "person face",
+    strength: float = None,
+) -> list[Image.Image]:
+    """Apply style to several frames in one img2img + ControlNet call.
+
+    Every image gets its own generator seeded with `seed`, so each result is
+    the same as stylizing that frame alone. Without a target resolution,
+    inputs of differing size are diffused at the first image's size and
+    resized back afterwards. `strength` overrides style.denoising_strength."""
     import config
 
-    original_size = source_image.size
+    original_sizes = [img.size for img in source_images]
+    batch_res = target_resolution or original_sizes[0]
 
-    # Downscale inputs if target resolution specified
-    if target_resolution:
-        source_image = source_image.resize(target_resolution, Image.LANCZOS)
-        openpose_image = openpose_image.resize(target_resolution, Image.LANCZOS)
-        depth_image = depth_image.resize(target_resolution, Image.LANCZOS)
+    # Downscale inputs to the shared (target) resolution
+    def _fit(images):
+        return [img if img.size == batch_res else img.resize(batch_res, Image.LANCZOS) for img in images]
 
-    generator = torch.Generator(device=pipe.device).manual_seed(seed)
-    prompt = style.prompt_template.replace("{face_description}", "person face")
+    source_images = _fit(source_images)
+    openpose_images = _fit(openpose_images)
+    depth_images = _fit(depth_images)
 
-    # Use LCM steps if enabled, otherwise fallback to num_inference_steps
-    inference_steps = style.lcm_steps if (config.USE_LCM_LORA and style.lcm_enabled) else style.num_inference_steps
+    count = len(source_images)
+    generators = [torch.Generator(device=pipe.device).manual_seed(seed) for _ in range(count)]
+    prompt_embeds, negative_embeds = encode_prompt(pipe, style, face_description)
 
     result = pipe(
-        prompt=prompt,
-        negative_prompt=style.negative_prompt,
-        image=source_image,
-        control_image=[openpose_image, depth_image],
-        num_inference_steps=inference_steps,
+        prompt_embeds=prompt_embeds.repeat(count, 1, 1),
+        negative_prompt_embeds=(
+            negative_embeds.repeat(count, 1, 1) if negative_embeds is not None else None
+        ),
+        image=source_images,
+        control_image=[openpose_images, depth_images],
+        num_inference_steps=inference_steps(style),
         guidance_scale=style.guidance_scale,
-        strength=style.denoising_strength,
+        strength=style.denoising_strength if strength is None else strength,
         controlnet_conditioning_scale=[
             style.controlnet_openpose_weight,
             style.controlnet_depth_weight,
         ],
-        generator=generator,
+        generator=generators,
     )
 
-    output = result.images[0]
-
     # Upscale back to original size if needed
-    if target_resolution and config.ENABLE_UPSCALING:
-        output = output.resize(original_size, Image.LANCZOS)
+    restore = not target_resolution or config.ENABLE_UPSCALING
+    return [
+        img.resize(size, Image.LANCZOS) if restore and img.size != size else img
+        for img, size in zip(result.images, original_sizes)
+    ]
+
+
+def auto_batch_size(device: str, resolution: tuple[int, int]) -> int:
+    """Pick a diffusion batch size from free accelerator memory.
+
+    Uses config.STYLIZE_MB_PER_MEGAPIXEL as the activation cost of one image
+    per megapixel of inference resolution; CPU gets config.STYLIZE_CPU_BATCH_SIZE."""
+    import config
+
+    if not str(device).startswith("cuda") or not torch.cuda.is_available():
+        return max(1, config.STYLIZE_CPU_BATCH_SIZE)
+    free_bytes, _ = torch.cuda.mem_get_info()
+    megapixels = resolution[0] * resolution[1] / 1e6
+    per_image = config.STYLIZE_MB_PER_MEGAPIXEL * megapixels * 1024 ** 2
+    return int(max(1, min(config.STYLIZE_MAX_BATCH_SIZE, free_bytes * 0.8 // per_image)))
+
 
-    return output
+def output_size(width: int, height: int) -> tuple[int, int]:
+    """(width, height) of stylized frames for a source of the given size."""
+    import config
+
+    if config.STYLIZE_FACE_ROI:
+        return width, height  # Crops are pasted back into the full frame
+    if config.INFERENCE_WIDTH > 0 and config.INFERENCE_HEIGHT > 0 and not config.ENABLE_UPSCALING:
+        return config.INFERENCE_WIDTH, config.INFERENCE_HEIGHT
+    return width, height
 
 
 def process_frames(
     style: StyleConfig,
     device: str,
     dtype: str,
-    frame_paths: list[Path],
-    openpose_paths: list[Path],
-    depth_paths: list[Path],
-    output_dir: Path,
+    frames: np.ndarray,
+    landmarks: np.ndarray,
+    detected: np.ndarray,
+    depth: np.ndarray,
+    landmark_indices: list[int],
+    depth_indices: list[int],
+    frame_indices: list[int],
+    out: np.ndarray,
     seed: int = 42,
-) -> list[Path]:
-    """Stylize all frames. Returns paths to styled frame images."""
-    import config
+    face_description: str = "person face",
+    on_stored: Callable[[list[int]], None] = None,
+) -> dict:
+    """Stylize the frames at `frame_indices`, writing each into the same slot
+    of `out` (sized by `output_size`).
 
-    output_dir.mkdir(parents=True, exist_ok=True)
-    pipe = load_pipeline(style, device, dtype)
-    styled_paths = []
+    `landmarks`/`detected` (see face_landmarks.save_landmarks) and the `depth`
+    track are compact: slot k belongs to frame landmark_indices[k] /
+    depth_indices[k], which must cover `frame_indices`. Pose images are
+    rendered on the fly directly at the inference resolution.
+
+    With config.STYLIZE_FACE_ROI, only a temporally stable padded box around
+    the face is diffused and feather-blended back into the source frame.
+    Results are looked up in / added to the content-addressed result cache
+    (config.RESULT_CACHE_ENABLED); the pipeline is only loaded on a miss.
+
+    With style.warm_start_blend > 0, every keyframe after the first starts
+    from its source blended with the previous result warped onto it by
+    optical flow, at a reduced denoising strength (fewer steps).
+    `on_stored` is called with each batch of frame indices once they are
+    written to `out` (e.g. to interpolate while later keyframes diffuse).
+    Returns {"count", "cache_hits", "cache_misses", "warm_started",
+    "steps_saved"}."""
+    import config
 
     # Determine target resolution from config
     target_res = None
@@ -121,19 +224,168 @@ def process_frames(
         target_res = (config.INFERENCE_WIDTH, config.INFERENCE_HEIGHT)
         print(f"  Using inference resolution: {target_res[0]}x{target_res[1]}")
 
-    for i, (fp, op, dp) in enumerate(zip(frame_paths, openpose_paths, depth_paths)):
-        src = Image.open(fp).convert("RGB")
-        pose = Image.open(op).convert("RGB")
-        depth = Image.open(dp).convert("RGB")
+    pose_slot = {idx: k for k, idx in enumerate(landmark_indices)}
+    depth_slot = {idx: k for k, idx in enumerate(depth_indices)}
+    height, width = frames.shape[1:3]
+    pose_w, pose_h = target_res or (width, height)
+    out_size = (out.shape[2], out.shape[1])
+
+    boxes = None
+    if config.STYLIZE_FACE_ROI:
+        boxes = face_roi.face_boxes(
+            landmarks, detected, width, height,
+            aspect=pose_w / pose_h,
+            padding=config.FACE_ROI_PADDING,
+            smoothing=config.FACE_ROI_SMOOTHING,
+        )
+        print("  Face ROI mode: stylizing a padded face box per keyframe")
+
+    def _prepare(idx: int):
+        """(source, pose, depth) images for frame idx, cropped in ROI mode."""
+        k = pose_slot[idx]
+        frame = frames[idx]
+        depth_map = depth[depth_slot[idx], :, :, 0]
+        face = landmarks[k] if detected[k] else None
+        if boxes is not None:
+            x0, y0, x1, y1 = boxes[k]
+            frame = frame[y0:y1, x0:x1]
+            depth_map = depth_map[y0:y1, x0:x1]
+            if face is not None:
+                face = face_roi.crop_landmarks(face, boxes[k], width, height)
+        src = Image.fromarray(np.ascontiguousarray(frame))
+        pose = Image.fromarray(face_landmarks.render_pose(face, pose_w, pose_h))
+        depth_img = Image.fromarray(np.ascontiguousarray(depth_map)).convert("RGB")
+        return src, pose, depth_img
+
+    def _store(idx: int, src: Image.Image, styled: Image.Image):
+        if boxes is not None:
+            crop = np.asarray(styled.convert("RGB").resize(src.size, Image.LANCZOS))
+            out[idx] = face_roi.paste_back(
+                frames[idx], crop, boxes[pose_slot[idx]], config.FACE_ROI_FEATHER
+            )
+            return
+        if styled.size != out_size:
+            styled = styled.resize(out_size, Image.LANCZOS)
+        out[idx] = np.asarray(styled.convert("RGB"))
+
+    warm_start = style.warm_start_blend > 0
+    if warm_start:
+        # Each keyframe depends on the previous result
+        batch_size = 1
+        warm_strength = warm_start_strength(style)
+        steps_per_frame = denoising_steps(style, style.denoising_strength)
+        warm_steps = denoising_steps(style, warm_strength)
+        print(
+            f"  Warm start: blend {style.warm_start_blend}, strength "
+            f"{style.denoising_strength} -> {warm_strength:.2f} "
+            f"({steps_per_frame} -> {warm_steps} steps)"
+        )
+    else:
+        batch_size = config.STYLIZE_BATCH_SIZE or auto_batch_size(device, (pose_w, pose_h))
+    print(f"  Diffusion batch size: {batch_size}")
+
+    def _warm_init(src: Image.Image, prev_src: np.ndarray, prev_styled: Image.Image):
+        """Source image blended with the previous result warped onto it."""
+        current = np.asarray(src)
+        warped = interpolate.warp_previous(
+            np.asarray(prev_styled.convert("RGB")), prev_src, current
+        )
+        blend = style.warm_start_blend
+        return Image.fromarray(cv2.addWeighted(warped, blend, current, 1 - blend, 0))
+
+    # Everything besides the input images that determines a result
+    lcm = config.USE_LCM_LORA and style.lcm_enabled
+    cache_params = {
+        "style": {name: getattr(style, name) for name in _DIFFUSION_FIELDS},
+        "seed": seed,
+        "steps": inference_steps(style),
+        "lcm": lcm,
+        "lcm_lora_id": config.LCM_LORA_ID if lcm else None,
+        "dtype": dtype,
+        "controlnets": [config.CONTROLNET_OPENPOSE_ID, config.CONTROLNET_DEPTH_ID],
+        "target_resolution": target_res,
+        "upscale": config.ENABLE_UPSCALING,
+        "face_description": face_description,
+    }
+    use_cache = config.RESULT_CACHE_ENABLED
+    hits = misses = 0
+    warm_started = steps_saved = 0
+    prev = None  # (source array, styled image) of the last keyframe
+    pipe = None
+
+    done = 0
+    while done < len(frame_indices):
+        batch = frame_indices[done:done + batch_size]
+        inputs = [_prepare(idx) for idx in batch]
+        sources = [src for src, _, _ in inputs]
+        params = cache_params
+        strength = None
+        if warm_start and prev is not None:
+            # Diffuse from the warm init instead of the raw source
+            inputs = [(_warm_init(inputs[0][0], *prev), *inputs[0][1:])]
+            strength = warm_strength
+            params = {**cache_params, "warm_strength": strength}
+        if use_cache:
+            keys = [result_cache.result_key(list(images), params) for images in inputs]
+            styled = [result_cache.get(key) for key in keys]
+        else:
+            keys = [None] * len(batch)
+            styled = [None] * len(batch)
+        todo = [j for j, img in enumerate(styled) if img is None]
+
+        if todo:
+            if pipe is None:
+                pipe = load_pipeline(style, device, dtype)
+            try:
+                results = stylize_batch(
+                    pipe, style,
+                    [inputs[j][0] for j in todo],
+                    [inputs[j][1] for j in todo],
+                    [inputs[j][2] for j in todo],
+                    seed=seed,
+                    target_resolution=target_res,
+                    face_description=face_description,
+                    strength=strength,
+                )
+            except torch.cuda.OutOfMemoryError:
+                if batch_size == 1:
+                    raise
+                torch.cuda.empty_cache()
+                batch_size = max(1, batch_size // 2)
+                print(f"  Out of memory, retrying with batch size {batch_size}")
+                continue
+            for j, img in zip(todo, results):
+                styled[j] = img
+                if use_cache:
+                    result_cache.put(keys[j], img)
+        hits += len(batch) - len(todo)
+        misses += len(todo)
 
-        styled = stylize_frame(pipe, style, src, pose, depth, seed=seed, target_resolution=target_res)
-        out_path = output_dir / f"styled_{fp.stem}.png"
-        styled.save(out_path)
-        styled_paths.append(out_path)
+        for idx, src, img in zip(batch, sources, styled):
+            _store(idx, src, img)
+        if on_stored:
+            on_stored(list(batch))
+        if warm_start:
+            if strength is not None:
+                warm_started += 1
+                steps_saved += steps_per_frame - warm_steps
+            prev = (np.asarray(sources[-1]), styled[-1])
 
-        if i % 10 == 0:
-            print(f"  Stylize: {i+1}/{len(frame_paths)}")
+        if done // 10 != (done + len(batch)) // 10 or done == 0:
+            print(f"  Stylize: {done + len(batch)}/{len(frame_indices)}")
+        done += len(batch)
 
-    del pipe
-    torch.cuda.empty_cache()
-    return styled_paths
+    out.flush()
+    if use_cache:
+        print(f"  Result cache: {hits} hits, {misses} misses")
+        result_cache.trim(config.RESULT_CACHE_MB)
+    if warm_start:
+        print(f"  Warm start: {warm_started} keyframes, {steps_saved} denoising steps saved")
+    # The pipeline stays in the model registry for the next style / job
+    return {
+        "count": len(frame_indices),
+        "cache_hits": hits,
+        "cache_misses": misses,
+        "warm_started": warm_started,
+        "steps_saved": steps_saved,
+    }
@@ -21,6 +21,12 @@ class StyleConfig:
     # LCM-LoRA optimization
     lcm_enabled: bool = True
     lcm_steps: int = 6  # Override num_inference_steps if LCM enabled
+    # Temporal warm start: init each keyframe from a flow-warped blend of the
+    # previous stylized keyframe and its own source (0 = off). Warm-started
+    # keyframes run at denoising_strength * warm_start_strength_scale, i.e.
+    # fewer denoising steps. Keyframes are then stylized one at a time.
+    warm_start_blend: float = 0.0
+    warm_start_strength_scale: float = 0.7
 
 
 STYLES: dict[str, StyleConfig] = {